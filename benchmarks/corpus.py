@@ -0,0 +1,180 @@
+import argparse
+import click
+import json
+import pathlib
+import random
+from tqdm import tqdm
+import yaml
+
+from buckets import get_bucket_path, get_buckets
+from wiktionary import Relationship, WikiText, WiktionaryDB
+
+REPO_ROOT = pathlib.Path(__file__).parent.parent
+# Roughly the number of names in the real dataset
+BASE_NAMES = 40000
+SCALES = [1, 10, 100]
+DEFAULT_SEED = 0
+
+SYLLABLES = ['a', 'al', 'an', 'ar', 'be', 'bel', 'bo', 'da', 'del', 'di', 'do', 'e', 'el', 'em', 'en', 'fa', 'fe',
+             'ga', 'gi', 'go', 'ha', 'he', 'i', 'il', 'is', 'ja', 'jo', 'ka', 'ki', 'la', 'le', 'li', 'lo', 'ma', 'me',
+             'mi', 'mo', 'na', 'ne', 'ni', 'no', 'o', 'ol', 'or', 'pa', 'pe', 'ra', 're', 'ri', 'ro', 'sa', 'se', 'si',
+             'so', 'ta', 'te', 'ti', 'to', 'u', 'va', 've', 'vi', 'wi', 'ya', 'za', 'zo']
+ACCENTS = {'a': 'á', 'e': 'é', 'i': 'í', 'o': 'ö', 'u': 'ü'}
+CYRILLIC = dict(zip('abdefgijklmnoprstuvyz', 'абдефгийклмнопрстувыз'))
+GREEK = dict(zip('abdefgijklmnoprstuvyz', 'αβδεφγιζκλμνοπρστυβυζ'))
+LANGUAGES = {'en': 'English', 'fr': 'French', 'de': 'German', 'es': 'Spanish', 'it': 'Italian', 'nl': 'Dutch',
+             'pl': 'Polish', 'sv': 'Swedish', 'ru': 'Russian', 'el': 'Greek'}
+ORIGINS = ['la', 'grc', 'gem', 'he', 'ang', 'non', 'sga']
+GENDERS = {1: 'female', 2: 'male', 4: 'unisex'}
+RELATIONSHIP_PARAMS = {Relationship.IS_SHORT_FOR: 'dim', Relationship.IS_A_VARIANT_OF: 'var',
+                       Relationship.IS_EQUIVALENT_TO: 'eq'}
+
+
+def make_name(rng):
+    name = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+    roll = rng.random()
+    if roll < 0.05:
+        name = ''.join(CYRILLIC.get(c, c) for c in name)
+    elif roll < 0.08:
+        name = ''.join(GREEK.get(c, c) for c in name)
+    elif roll < 0.13:
+        i = rng.randrange(len(name))
+        name = name[:i] + ACCENTS.get(name[i], name[i]) + name[i + 1:]
+    return name.title()
+
+
+def generate_entries(num_names, rng):
+    names = []
+    seen = set()
+    while len(names) < num_names:
+        name = make_name(rng)
+        if name not in seen:
+            seen.add(name)
+            names.append(name)
+
+    entries = {}
+    for i, name in enumerate(names):
+        entry = {'gender_flag': rng.choice(list(GENDERS)),
+                 'lang': sorted(rng.sample(list(LANGUAGES), rng.randint(1, 3)))}
+        if rng.random() < 0.5:
+            entry['origin'] = sorted(rng.sample(ORIGINS, rng.randint(1, 2)))
+        for rel, chance in [(Relationship.IS_SHORT_FOR, 0.4), (Relationship.IS_A_VARIANT_OF, 0.1),
+                            (Relationship.IS_EQUIVALENT_TO, 0.05)]:
+            if i and rng.random() < chance:
+                others = {names[rng.randrange(i)] for _ in range(rng.randint(1, 2))}
+                entry[rel.name.lower()] = sorted(others)
+        entries[name] = entry
+    return entries
+
+
+def make_page(name, entry, rng):
+    """Wiktionary-style wikitext with a {{given name}} template for the entry"""
+    lang = entry['lang'][0]
+    params = [lang, GENDERS[entry['gender_flag']]]
+    for origin in entry.get('origin', []):
+        params.append(f'from={origin}')
+    for rel, param in RELATIONSHIP_PARAMS.items():
+        for i, other in enumerate(entry.get(rel.name.lower(), [])):
+            params.append(f'{param}{i + 1 if i else ""}={other}')
+    filler = '{{l|en|filler}} text ' * rng.randint(5, 50)
+    return (f'=={LANGUAGES[lang]}==\n===Etymology===\nFrom {{{{der|{lang}|la|{name}us}}}} [[link]].\n'
+            f'===Proper noun===\n{{{{head|{lang}|proper noun}}}}\n# {{{{given name|{"|".join(params)}}}}}\n'
+            f'{filler}\n')
+
+
+def write_wiktionary_db(out, entries, rng):
+    folder = out / 'wiktionary'
+    folder.mkdir(parents=True, exist_ok=True)
+    db = WiktionaryDB(folder)
+    db.load_yaml(pathlib.Path(__file__).parent.parent / 'wiktionary' / 'wiktionary.yaml')
+    db.update_database_structure()
+
+    categories = {}
+    names = []
+    memberships = []
+    for name_id, (name, entry) in enumerate(tqdm(entries.items(), desc='Pages'), 1):
+        names.append((name_id, name, WikiText(make_page(name, entry, rng))))
+        for lang in entry['lang']:
+            category = f'Category:{LANGUAGES[lang]} {GENDERS[entry["gender_flag"]]} given names'
+            if category not in categories:
+                categories[category] = len(categories) + 1
+            memberships.append((categories[category], name_id))
+
+    db.bulk_insert('names', ['id', 'name', 'wiki_text'], names)
+    db.bulk_insert('categories', ['id', 'name'], [(cat_id, name) for name, cat_id in categories.items()])
+    db.bulk_insert('category_membership', ['category_id', 'name_id'], memberships)
+    db.close(print_table_sizes=False)
+
+
+def write_buckets(out, entries):
+    root = out / 'data'
+    root.mkdir(parents=True, exist_ok=True)
+    names = list(entries)
+    buckets = {}
+    for name, bucket in zip(names, get_buckets(names)):
+        buckets.setdefault(bucket, {})[name] = entries[name]
+    for bucket, data in buckets.items():
+        with open(get_bucket_path(bucket, root), 'w') as f:
+            yaml.safe_dump(data, f, allow_unicode=True)
+
+
+def write_misc_sources(out, entries):
+    """Raw files for each of the misc sources, in their original formats"""
+    formal = {}
+    for name, entry in entries.items():
+        for other in entry.get('is_short_for', []):
+            formal.setdefault(other, []).append(name)
+    items = sorted(formal.items())
+    files = {
+        'brianary/nicknames.txt': ''.join(f'{n}\t{" ".join(v)}\n' for n, v in items),
+        'carltonnorthern/names.csv': ''.join(f'{n.lower()},{",".join(x.lower() for x in v)}\n' for n, v in items),
+        'hajongler/male_diminutives.csv': ''.join(f'{n},{",".join(v)}\n' for n, v in items[::2]),
+        'hajongler/female_diminutives.csv': ''.join(f'{n},{",".join(v)}\n' for n, v in items[1::2]),
+        'meranda/nicknames.txt': '# nickname\tname\tscore\n' + ''.join(f'{x.upper()}\t{n.upper()}\t0.5\n'
+                                                                       for n, v in items for x in v),
+        'onyxrev/nicknames.csv': 'id,name,nickname\n' + ''.join(f'{i},{n.lower()},{x.lower()}\n'
+                                                                for i, (n, v) in enumerate(items) for x in v),
+        'mrcsabatoth/name_to_nick.csv': 'firstname,nick\n' + ''.join(
+            f'{n.upper()},{",".join(x.upper() for x in v)}\n' for n, v in items),
+    }
+    for filename, contents in files.items():
+        path = out / 'misc_sources' / 'cache' / filename
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(contents)
+
+
+def is_in_repo(path):
+    """Whether the path is inside the repository, where a corpus would replace the real data and caches"""
+    return pathlib.Path(path).resolve().is_relative_to(REPO_ROOT.resolve())
+
+
+def generate(out, scale=1, seed=DEFAULT_SEED):
+    """Write a synthetic corpus to out: a wiktionary.db full of pages, the bucket files and the misc source files.
+
+    The same scale and seed always produce the same corpus."""
+    out = pathlib.Path(out)
+    rng = random.Random(seed)
+    entries = generate_entries(BASE_NAMES * scale, rng)
+    write_wiktionary_db(out, entries, rng)
+    write_buckets(out, entries)
+    write_misc_sources(out, entries)
+    manifest = {'scale': scale, 'seed': seed, 'names': len(entries), 'pages': len(entries)}
+    with open(out / 'corpus.json', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a deterministic synthetic corpus for benchmarking')
+    parser.add_argument('out', type=pathlib.Path)
+    parser.add_argument('-s', '--scale', type=int, choices=SCALES, default=1,
+                        help=f'Multiple of {BASE_NAMES} names to generate')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    args = parser.parse_args()
+
+    if args.out.exists():
+        parser.error(f'{args.out} already exists')
+    if is_in_repo(args.out):
+        parser.error(f'{args.out} is inside the repository, use a scratch directory outside of it')
+    manifest = generate(args.out, args.scale, args.seed)
+    click.secho(f'Generated {manifest["names"]} names in {args.out}', fg='green')
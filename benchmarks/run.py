@@ -0,0 +1,155 @@
+import argparse
+import click
+import json
+import os
+import pathlib
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from .corpus import SCALES, is_in_repo
+
+REPO_ROOT = pathlib.Path(__file__).parent.parent
+BASELINE_PATH = pathlib.Path(__file__).parent / 'baseline.json'
+# The code that is copied into the working directory, on top of the corpus
+CODE_PATHS = ['bin', 'buckets.py', 'instrumentation.py', 'benchmarks', 'misc_sources', 'name_data', 'wiktionary',
+              'db/names.yaml', '.bucket_table.json']
+IGNORE_PATTERNS = shutil.ignore_patterns('__pycache__', '*.db', 'cache', 'langcodes_cache.yaml', 'baseline.json')
+
+# Each stage's command (run from the working directory) and which corpus count its throughput is measured in
+STAGES = {
+    'get_bucket': ([sys.executable, '-c', 'from benchmarks.run import time_get_bucket; time_get_bucket()'], 'names'),
+    'parse_wiki': ([sys.executable, 'bin/parse_wiki', '-a'], 'pages'),
+    'dump_wiki': ([sys.executable, 'bin/dump_wiki'], 'pages'),
+    'update_misc_sources': ([sys.executable, 'bin/update_misc_sources', '-f'], 'names'),
+    'build_db': ([sys.executable, 'bin/build_db', '-f'], 'names'),
+}
+
+
+def time_get_bucket():
+    """Time get_buckets and get_bucket over every name in the bucket files, and print the time as json"""
+    from buckets import get_bucket, get_bucket_table, get_buckets, load_bucket_file
+
+    names = []
+    for path in sorted(pathlib.Path('data').glob('*.yaml')):
+        names += list(load_bucket_file(path))
+    get_bucket_table()
+
+    start = time.perf_counter()
+    get_buckets(names)
+    for name in names:
+        get_bucket(name)
+    print(json.dumps({'seconds': time.perf_counter() - start}))
+
+
+def prepare_workdir(corpus, workdir):
+    shutil.copytree(corpus, workdir, dirs_exist_ok=True)
+    for code_path in CODE_PATHS:
+        src = REPO_ROOT / code_path
+        dst = workdir / code_path
+        if src.is_dir():
+            shutil.copytree(src, dst, dirs_exist_ok=True, ignore=IGNORE_PATTERNS)
+        elif src.exists():
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy(src, dst)
+
+
+def run_stage(command, workdir, log_path):
+    """Run the command to completion, returning the elapsed seconds, peak memory in MiB and the output"""
+    env = dict(os.environ, PYTHONPATH=str(workdir))
+    with open(log_path, 'w') as log:
+        start = time.perf_counter()
+        proc = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.PIPE, stderr=log, text=True)
+        output = proc.stdout.read()
+        _, status, rusage = os.wait4(proc.pid, 0)
+        seconds = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        log.write(output)
+    if proc.returncode:
+        raise RuntimeError(f'{" ".join(command)} failed, see {log_path}')
+    # ru_maxrss is in kilobytes on Linux, but bytes on macOS
+    peak = rusage.ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+    return seconds, peak, output
+
+
+def run(corpus, workdir, stages):
+    manifest = json.load(open(corpus / 'corpus.json'))
+    prepare_workdir(corpus, workdir)
+    (workdir / 'logs').mkdir(exist_ok=True)
+
+    results = {'corpus': manifest, 'python': platform.python_version(), 'machine': platform.machine(), 'stages': {}}
+    for stage in stages:
+        command, unit = STAGES[stage]
+        click.secho(f'Running {stage:20}', nl=False)
+        seconds, peak, output = run_stage(command, workdir, workdir / 'logs' / f'{stage}.log')
+        lines = output.strip().splitlines()
+        if stage == 'get_bucket' and lines:
+            seconds = json.loads(lines[-1])['seconds']
+        items = manifest[unit]
+        results['stages'][stage] = {
+            'seconds': round(seconds, 3),
+            unit: items,
+            f'{unit}_per_second': round(items / seconds, 1),
+            'peak_memory_mb': round(peak, 1),
+        }
+        click.secho(f' {seconds:8.2f}s {items / seconds:12.1f} {unit}/s {peak:8.1f} MiB', fg='bright_blue')
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print each stage's change against the baseline, and return the names of the stages that regressed"""
+    regressions = []
+    if baseline['corpus'] != results['corpus']:
+        click.secho(f'Warning: baseline corpus {baseline["corpus"]} differs from {results["corpus"]}', fg='yellow')
+    for stage, result in results['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        for key in ['seconds', 'peak_memory_mb']:
+            before = baseline['stages'][stage][key]
+            after = result[key]
+            change = (after - before) / before if before else 0.0
+            regressed = change > threshold
+            if regressed:
+                regressions.append(stage)
+            color = 'red' if regressed else 'green' if change < -threshold else 'white'
+            click.secho(f'{stage:20} {key:16} {before:10.2f} -> {after:10.2f} ({change:+.1%})', fg=color)
+    return sorted(set(regressions))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time each pipeline stage against a synthetic corpus')
+    parser.add_argument('corpus', type=pathlib.Path,
+                        help=f'Directory made by bin/make_corpus (at a scale of {", ".join(map(str, SCALES))}x)')
+    parser.add_argument('-s', '--stages', nargs='+', choices=list(STAGES), default=list(STAGES))
+    parser.add_argument('-o', '--output', type=pathlib.Path, help='Write the results to this json file')
+    parser.add_argument('-b', '--baseline', type=pathlib.Path, default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                        help='Fractional slowdown (or memory increase) over the baseline that counts as a regression')
+    parser.add_argument('-w', '--workdir', type=pathlib.Path,
+                        help='Run in this directory (and keep it) instead of a temporary one')
+    args = parser.parse_args()
+    if args.workdir and is_in_repo(args.workdir):
+        parser.error(f'{args.workdir} is inside the repository, use a scratch directory outside of it')
+
+    if args.workdir:
+        results = run(args.corpus, args.workdir, args.stages)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = run(args.corpus, pathlib.Path(workdir), args.stages)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        click.secho(f'Saved baseline to {args.baseline}', fg='green')
+    elif args.baseline.exists():
+        regressions = compare(results, json.load(open(args.baseline)), args.threshold)
+        if regressions:
+            click.secho(f'Regressions in {", ".join(regressions)}', fg='red')
+            sys.exit(1)
@@ -1,5 +1,14 @@
+import bisect
+import click
+import hashlib
+import importlib.metadata
+import json
+import os
+import pathlib
+import sys
 import unicodedata
 from unidecode import unidecode
+import yaml
 
 LETTER_ALPHABETS = ['LATIN']
 CHUNKS = ['NO', 'QR', 'UVW', 'XYZ']
@@ -8,6 +17,7 @@ for chunk in CHUNKS:
     for letter in chunk:
         REMAP_ALPHABET[letter] = chunk
 FULL_ALPHABETS = ['CYRILLIC', 'HIRAGANA', 'GREEK', 'ARABIC', 'ARMENIAN', 'BENGALI', 'HEBREW']
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
 
 def get_alphabet(category_name):
@@ -29,15 +39,15 @@ def get_ascii_letter(letter):
         return translated
 
 
-def get_bucket(s):
-    letter = s[0]
+def classify_letter(letter):
+    """Determine the bucket for a single character from the rules above"""
     cat = unicodedata.category(letter)
     if cat[0] != 'L':
         return 'Other',
 
     try:
         category_name = unicodedata.name(letter)
-    except KeyError:
+    except (KeyError, ValueError):
         return 'Other',
 
     if category_name.startswith('CJK'):
@@ -56,3 +66,114 @@ def get_bucket(s):
         return alphabet.title(),
     else:
         return 'OtherLetter',
+
+
+BUCKET_TABLE_PATH = pathlib.Path(__file__).parent / '.bucket_table.json'
+_bucket_table = None
+
+
+def get_bucket_table_version():
+    """The table depends on the unicode database, unidecode and the rules themselves"""
+    rules = repr((LETTER_ALPHABETS, CHUNKS, FULL_ALPHABETS))
+    return f'{unicodedata.unidata_version} {importlib.metadata.version("unidecode")} {rules}'
+
+
+def build_bucket_table():
+    """Classify every codepoint, compressed into runs of consecutive codepoints with the same bucket.
+
+    Returns a list of the starting codepoint of each run, and the matching list of buckets"""
+    starts = []
+    buckets = []
+    for codepoint in range(sys.maxunicode + 1):
+        bucket = classify_letter(chr(codepoint))
+        if not buckets or bucket != buckets[-1]:
+            starts.append(codepoint)
+            buckets.append(bucket)
+    return starts, buckets
+
+
+def get_bucket_table():
+    global _bucket_table
+    if _bucket_table:
+        return _bucket_table
+
+    version = get_bucket_table_version()
+    if BUCKET_TABLE_PATH.exists():
+        with open(BUCKET_TABLE_PATH) as f:
+            data = json.load(f)
+        if data.get('version') == version:
+            _bucket_table = data['starts'], [tuple(bucket) for bucket in data['buckets']]
+            return _bucket_table
+
+    _bucket_table = build_bucket_table()
+    starts, buckets = _bucket_table
+    # Written to a temporary file and renamed, so that other processes never load a partially written table
+    temp_path = BUCKET_TABLE_PATH.with_name(f'{BUCKET_TABLE_PATH.name}.{os.getpid()}.tmp')
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump({'version': version, 'starts': starts, 'buckets': buckets}, f)
+        os.replace(temp_path, BUCKET_TABLE_PATH)
+    except OSError:
+        temp_path.unlink(missing_ok=True)
+    return _bucket_table
+
+
+def get_letter_bucket(letter):
+    starts, buckets = get_bucket_table()
+    return buckets[bisect.bisect_right(starts, ord(letter)) - 1]
+
+
+def get_bucket(s):
+    return get_letter_bucket(s[0])
+
+
+def get_buckets(names):
+    """Return the bucket for each of the names, classifying each distinct first letter only once"""
+    letter_buckets = {letter: get_letter_bucket(letter) for letter in {name[0] for name in names}}
+    return [letter_buckets[name[0]] for name in names]
+
+
+def get_bucket_path(bucket, root):
+    return root / ('_'.join(bucket) + '.yaml')
+
+
+def file_hash(path):
+    return hashlib.sha1(path.read_bytes()).hexdigest()
+
+
+def load_bucket_file(path):
+    return yaml.load(open(path), Loader=YAML_LOADER)
+
+
+def write_yaml_if_changed(path, data):
+    """Write the data to path via a temporary file and an atomic rename.
+
+    Nothing is written if the file already has the same contents. Returns whether the file was written."""
+    contents = yaml.safe_dump(data, allow_unicode=True)
+    if path.exists() and path.read_text() == contents:
+        return False
+    temp_path = path.with_name(path.name + '.tmp')
+    temp_path.write_text(contents)
+    os.replace(temp_path, path)
+    return True
+
+
+def update_bucket(bucket, root, updates, apply_fn, prepare=None):
+    """Load the data for a single bucket, call apply_fn(data, name, update) for each update, then write it"""
+    path = get_bucket_path(bucket, root)
+    if path.exists():
+        data = yaml.safe_load(open(path)) or {}
+    else:
+        data = {}
+
+    for name, update in updates:
+        apply_fn(data, name, update)
+
+    if prepare:
+        data = prepare(data)
+    written = write_yaml_if_changed(path, data)
+
+    bucket_s = ' '.join(bucket)
+    click.secho('Writing ' if written else 'Skipped ', nl=False)
+    click.secho(f'{bucket_s:20}', nl=False, fg='bright_blue' if written else 'white')
+    click.secho(f' ({len(updates)} names)')
@@ -0,0 +1,196 @@
+"""Timers and counters for the pipeline stages, written to a json file at the end of each run.
+
+install_hooks wraps the libraries the pipeline spends its time in (sqlite via MetroDB, requests, yaml and
+mwparserfromhell), so they are measured without changing the code that calls them. Only the main process is
+measured; work done in multiprocessing workers shows up in the time of the stage that waits on them."""
+import collections
+import contextlib
+import cProfile
+import datetime
+import functools
+import json
+import pathlib
+import sys
+import threading
+import time
+
+import click
+
+METRICS_FOLDER = pathlib.Path('metrics')
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.seconds = collections.Counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiler = None
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Add the time spent in the block to the named timer, and count the number of calls.
+
+        If the block is already inside a timer with the same name (i.e. yaml.safe_load calling yaml.load),
+        only the outer one is counted"""
+        active = self.local.__dict__.setdefault('active', set())
+        if name in active:
+            yield
+            return
+        active.add(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            active.discard(name)
+            with self.lock:
+                self.seconds[name] += elapsed
+                self.counters[name] += 1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def add_time(self, name, seconds):
+        """Add time measured outside of a timer block, without counting another call"""
+        with self.lock:
+            self.seconds[name] += seconds
+
+    @contextlib.contextmanager
+    def hot_loop(self):
+        """Profile the block if --profile was given"""
+        if self.profiler is None:
+            yield
+            return
+        self.profiler.enable()
+        try:
+            yield
+        finally:
+            self.profiler.disable()
+
+    def as_dict(self):
+        return {
+            'counters': dict(sorted(self.counters.items())),
+            'seconds': {name: round(seconds, 4) for name, seconds in sorted(self.seconds.items())},
+        }
+
+
+metrics = Metrics()
+timer = metrics.timer
+count = metrics.count
+add_time = metrics.add_time
+hot_loop = metrics.hot_loop
+
+
+def wrap(owner, attr, name, on_result=None):
+    """Replace owner.attr with a version that is timed with the named timer"""
+    fn = getattr(owner, attr)
+    if getattr(fn, 'instrumented', False):
+        return
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with timer(name):
+            result = fn(*args, **kwargs)
+        if on_result:
+            on_result(result, *args, **kwargs)
+        return result
+
+    wrapper.instrumented = True
+    setattr(owner, attr, wrapper)
+
+
+def timed_rows(rows, name):
+    """Yield the rows, adding the time spent fetching them to the named timer"""
+    elapsed = 0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                row = next(rows)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - start
+            yield row
+    finally:
+        add_time(name, elapsed)
+
+
+def time_iteration(result, db, query):
+    """SQLiteDB.query returns before most of the rows are fetched, so the fetching is timed as they are used"""
+    result.iterable = timed_rows(result.iterable, 'sql')
+
+
+def count_rows(result, db, command, params=()):
+    if hasattr(params, '__len__'):
+        count('sql.rows', len(params))
+
+
+def count_bytes(response, session, request, **kwargs):
+    if kwargs.get('stream'):
+        count('http.bytes', int(response.headers.get('Content-Length', 0)))
+    else:
+        count('http.bytes', len(response.content))
+
+
+def install_hooks():
+    import yaml
+    from metro_db.sqlite_db import SQLiteDB
+
+    # execute returns the cursor itself, so rows fetched from it afterwards (i.e. with fetchall) are not timed
+    for attr in ['query_one', 'execute']:
+        wrap(SQLiteDB, attr, 'sql')
+    wrap(SQLiteDB, 'query', 'sql', time_iteration)
+    wrap(SQLiteDB, 'execute_many', 'sql', count_rows)
+    for attr in ['load', 'safe_load']:
+        wrap(yaml, attr, 'yaml.load')
+    for attr in ['dump', 'safe_dump']:
+        wrap(yaml, attr, 'yaml.dump')
+
+    try:
+        import requests
+        wrap(requests.Session, 'send', 'http', count_bytes)
+    except ImportError:
+        pass
+
+    try:
+        import mwparserfromhell
+        wrap(mwparserfromhell, 'parse', 'mwparserfromhell.parse')
+    except ImportError:
+        pass
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group('instrumentation')
+    group.add_argument('--metrics', type=pathlib.Path,
+                       help=f'Where to write the metrics for the run (default: {METRICS_FOLDER}/<script>_<time>.json)')
+    group.add_argument('--profile', action='store_true',
+                       help='Write cProfile stats for the main loop next to the metrics file')
+
+
+@contextlib.contextmanager
+def instrument(script, args):
+    """Measure the block, then write the metrics (and the profile stats, if requested) for the run"""
+    install_hooks()
+    started = datetime.datetime.now()
+    metrics_path = args.metrics or METRICS_FOLDER / f'{script}_{started:%Y%m%d_%H%M%S}.json'
+    if args.profile:
+        metrics.profiler = cProfile.Profile()
+
+    try:
+        with timer(f'total.{script}'):
+            yield metrics
+    finally:
+        metrics_path.parent.mkdir(parents=True, exist_ok=True)
+        data = {'script': script, 'argv': sys.argv[1:], 'started': started.isoformat(timespec='seconds')}
+        data.update(metrics.as_dict())
+        with open(metrics_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        click.secho(f'Wrote metrics to {metrics_path}', fg='bright_black')
+
+        if metrics.profiler:
+            profile_path = metrics_path.with_suffix('.prof')
+            metrics.profiler.dump_stats(profile_path)
+            click.secho(f'Wrote profile to {profile_path} (view with python -m pstats)', fg='bright_black')
@@ -1,10 +1,18 @@
 import argparse
+import concurrent.futures
+import heapq
+import itertools
+import multiprocessing
+import operator
 import pathlib
 import requests
+import urllib3
 import click
 import yaml
 
-from buckets import get_bucket
+from buckets import YAML_LOADER, file_hash, get_buckets, update_bucket
+from instrumentation import add_arguments, hot_loop, instrument, timer
+from wiktionary.api import RETRY_STATUS_CODES, USER_AGENT
 
 SOURCES = {
     'brianary': 'https://raw.githubusercontent.com/brianary/Lingua-EN-Nickname/main/nicknames.txt',
@@ -17,179 +25,356 @@ SOURCES = {
 }
 
 CACHE_FOLDER = pathlib.Path('misc_sources/cache')
+# Stored in each source's cache folder, with the ETag / Last-Modified headers of each raw file
+VALIDATORS_FILENAME = 'validators.yaml'
+# Stored in each source's cache folder, with the hash of each raw file that its common.yaml was parsed from
+PARSED_FILENAME = 'parsed.yaml'
+# The hashes of each source's common.yaml and of the bucket files, as they were after the last integrate
+INTEGRATED_PATH = CACHE_FOLDER / 'integrated.yaml'
 ROOT = pathlib.Path('data/')
 ROOT.mkdir(exist_ok=True)
 
 
-def download(redownload=False):
+def get_urls(urldata):
+    if isinstance(urldata, str):
+        return [urldata]
+    return urldata
+
+
+def make_session(jobs, retries=5, backoff=1.0):
+    session = requests.Session()
+    session.headers['User-Agent'] = USER_AGENT
+    retry = urllib3.util.Retry(total=retries, backoff_factor=backoff, status_forcelist=sorted(RETRY_STATUS_CODES),
+                               respect_retry_after_header=True)
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(jobs, 1), max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def load_yaml_file(path):
+    if path.exists():
+        with open(path) as f:
+            return yaml.safe_load(f) or {}
+    return {}
+
+
+def save_yaml_file(path, data):
+    with open(path, 'w') as f:
+        yaml.safe_dump(data, f)
+
+
+def save_validators(validators):
+    for name, src_validators in validators.items():
+        save_yaml_file(CACHE_FOLDER / name / VALIDATORS_FILENAME, src_validators)
+
+
+def fetch(session, url, filepath, validators, timeout):
+    """Download url to filepath, unless the validators show that it has not changed since the last download.
+
+    Returns whether the file changed, and the new validators"""
+    headers = {}
+    if filepath.exists():
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    req = session.get(url, headers=headers, timeout=timeout)
+    if req.status_code == 304:
+        return False, validators
+    req.raise_for_status()
+
+    new_validators = {'etag': req.headers.get('ETag'), 'last_modified': req.headers.get('Last-Modified')}
+    if filepath.exists() and filepath.read_bytes() == req.content:
+        return False, new_validators
+    temp_path = filepath.with_name(filepath.name + '.tmp')
+    temp_path.write_bytes(req.content)
+    temp_path.replace(filepath)
+    return True, new_validators
+
+
+def download(redownload=False, jobs=len(SOURCES), timeout=60):
+    """Make sure all the raw files are in the cache, downloading them concurrently.
+
+    With redownload, the existing files are checked for changes with conditional requests.
+    Returns the list of (src, path) for all the raw files, the set of paths that changed and the new validators
+    of each source that was fetched. The validators are saved by the caller once the files have been parsed
+    and integrated, so that a failed run fetches them again"""
     raw_files = []
+    to_fetch = []
+    validators = {}
     for name, urldata in SOURCES.items():
         src_folder = CACHE_FOLDER / name
-        src_folder.mkdir(exist_ok=True)
-        if isinstance(urldata, str):
-            urls = [urldata]
-        else:
-            urls = urldata
-        for url in urls:
+        src_folder.mkdir(parents=True, exist_ok=True)
+        validators[name] = load_yaml_file(src_folder / VALIDATORS_FILENAME)
+        for url in get_urls(urldata):
             filename = url.split('/')[-1]
             filepath = src_folder / filename
             raw_files.append((name, filepath))
-            if filepath.exists() and not redownload:
-                continue
-            click.secho(f'Downloading {url}...', fg='blue')
-            req = requests.get(url)
-            with open(filepath, 'w') as f:
-                f.write(req.text)
-    return raw_files
+            if redownload or not filepath.exists():
+                to_fetch.append((name, url, filepath))
 
+    changed = set()
+    session = make_session(jobs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = {executor.submit(fetch, session, url, filepath, validators[name].get(filepath.name, {}), timeout):
+                   (name, url, filepath) for name, url, filepath in to_fetch}
+        for future in concurrent.futures.as_completed(futures):
+            name, url, filepath = futures[future]
+            is_changed, validators[name][filepath.name] = future.result()
+            if is_changed:
+                click.secho(f'Downloaded {url}', fg='blue')
+                changed.add(filepath)
+            else:
+                click.secho(f'Unchanged {url}', fg='green')
 
-def parse_to_common(raw_files):
-    common = {}
-    for src, path in raw_files:
-        if src not in common:
-            common[src] = {}
-
-        def add_nick(name, nick, key='is_short_for'):
-            if nick not in common[src]:
-                common[src][nick] = {}
-            if key not in common[src][nick]:
-                common[src][nick][key] = []
-            if name not in common[src][nick][key]:
-                common[src][nick][key].append(name)
-
-        def add_gender(name, gender_flag, key='gender_flag'):
-            if name not in common[src]:
-                common[src][name] = {}
-            if key not in common[src][name]:
-                common[src][name][key] = 0
-            common[src][name][key] |= gender_flag
-
-        if src == 'brianary':
-            for line in open(path).readlines():
-                pieces = line.strip().split('\t')
-                name = pieces[0]
-                nicks = pieces[1].split(' ')
-                for nick in nicks:
-                    if nick.endswith('E'):
-                        # https://github.com/brianary/Lingua-EN-Nickname/blob/07258c7d401fb3eb03af373c2a6f86c31f0b2cfd/Nickname.pm#L142
-                        root = nick[:-1]
-                        for ending in ['i', 'ie', 'ey', 'y']:
-                            if name == root + ending:
-                                continue
-                            add_nick(name, f'{root}{ending}')
-                    else:
-                        add_nick(name, nick)
-        elif src == 'carltonnorthern':
-            for line in open(path).readlines():
-                pieces = line.strip().split(',')
-                name = pieces[0].title()
-                nicks = pieces[1:]
-                for nick in nicks:
-                    nick = nick.title()
-                    add_nick(name, nick)
-        elif src == 'hajongler':
-            gender_s = path.name.split('_')[0]
-            if gender_s == 'female':
-                gender_flag = 1
+    fetched = {name for name, _, _ in to_fetch}
+    return raw_files, changed, {name: validators[name] for name in fetched}
+
+
+# Each parser takes the path to a raw file and yields (name, key, value) records.
+# For gender_flag, the values are OR'ed together. For other keys, the entry is the list of unique values.
+PARSERS = {}
+
+
+def source_parser(src):
+    def register(fn):
+        PARSERS[src] = fn
+        return fn
+    return register
+
+
+def nick_record(name, nick):
+    return nick, 'is_short_for', name
+
+
+def gender_record(name, gender_flag):
+    return name, 'gender_flag', gender_flag
+
+
+@source_parser('brianary')
+def parse_brianary(path):
+    for line in open(path):
+        pieces = line.strip().split('\t')
+        name = pieces[0]
+        nicks = pieces[1].split(' ')
+        for nick in nicks:
+            if nick.endswith('E'):
+                # https://github.com/brianary/Lingua-EN-Nickname/blob/07258c7d401fb3eb03af373c2a6f86c31f0b2cfd/Nickname.pm#L142
+                root = nick[:-1]
+                for ending in ['i', 'ie', 'ey', 'y']:
+                    if name == root + ending:
+                        continue
+                    yield nick_record(name, f'{root}{ending}')
             else:
-                gender_flag = 2
-            for line in open(path).readlines():
-                pieces = line.strip().split(',')
-                name = pieces[0]
-                nicks = pieces[1:]
-                add_gender(name, gender_flag)
-                for nick in nicks:
-                    add_gender(nick, gender_flag)
-                    add_nick(name, nick)
-        elif src == 'meranda':
-            for line in open(path).readlines():
-                if line[0] == '#':
-                    continue
-                # Special case due to bad formatting
-                line = line.replace('  GEORGINE        0', '\tGEORGINE\t0')
-
-                pieces = line.strip().lower().replace('\t\t', '\t').split('\t')
-                if len(pieces) != 3:
-                    click.secho(repr(line), fg='red')
-                    continue
-                nick = pieces[0].title()
-                name = pieces[1].title()
-                add_nick(name, nick)
-        elif src == 'mrcsabatoth':
-            for line in open(path).readlines():
-                if line.startswith('firstname'):
-                    continue
-                pieces = line.strip().title().split(',')
-                name = pieces[0]
-                nicks = pieces[1:]
-                for nick in nicks:
-                    add_nick(name, nick)
-        elif src == 'onyxrev':
-            for line in open(path).readlines():
-                if line.startswith('id,'):
-                    continue
-                pieces = list(map(str.strip, line.title().split(',')))
-                name = pieces[1]
-                nick = pieces[2]
-                if name == nick:
-                    continue
-                add_nick(name, nick)
-        else:
-            click.secho(f'Skipping {src}', fg='yellow')
+                yield nick_record(name, nick)
 
-    for src, data in common.items():
-        fn = CACHE_FOLDER / src / 'common.yaml'
-        yaml.dump(data, open(fn, 'w'))
 
-    return common
+@source_parser('carltonnorthern')
+def parse_carltonnorthern(path):
+    for line in open(path):
+        pieces = line.strip().split(',')
+        name = pieces[0].title()
+        nicks = pieces[1:]
+        for nick in nicks:
+            nick = nick.title()
+            yield nick_record(name, nick)
 
 
-def integrate(common):
-    all_names = set()
-    for src, data in common.items():
-        all_names = all_names.union(set(data.keys()))
-
-    current_bucket = None
-    current_path = None
-    current_data = None
-    for name in sorted(all_names):
-        bucket = get_bucket(name)
-        if bucket != current_bucket:
-            if current_data is not None:
-                yaml.safe_dump(current_data, open(current_path, 'w'), allow_unicode=True)
-            current_bucket = bucket
-            bucket_s = ' '.join(bucket)
-            click.secho('Switching to ', nl=False)
-            click.secho(f'{bucket_s:20}', nl=False, fg='bright_blue')
-            click.secho(f' ({name})')
-            current_path = ROOT / ('_'.join(bucket) + '.yaml')
-            if current_path.exists():
-                current_data = yaml.safe_load(open(current_path))
+@source_parser('hajongler')
+def parse_hajongler(path):
+    gender_s = path.name.split('_')[0]
+    if gender_s == 'female':
+        gender_flag = 1
+    else:
+        gender_flag = 2
+    for line in open(path):
+        pieces = line.strip().split(',')
+        name = pieces[0]
+        nicks = pieces[1:]
+        yield gender_record(name, gender_flag)
+        for nick in nicks:
+            yield gender_record(nick, gender_flag)
+            yield nick_record(name, nick)
+
+
+@source_parser('meranda')
+def parse_meranda(path):
+    for line in open(path):
+        if line[0] == '#':
+            continue
+        # Special case due to bad formatting
+        line = line.replace('  GEORGINE        0', '\tGEORGINE\t0')
+
+        pieces = line.strip().lower().replace('\t\t', '\t').split('\t')
+        if len(pieces) != 3:
+            click.secho(repr(line), fg='red')
+            continue
+        nick = pieces[0].title()
+        name = pieces[1].title()
+        yield nick_record(name, nick)
+
+
+@source_parser('mrcsabatoth')
+def parse_mrcsabatoth(path):
+    for line in open(path):
+        if line.startswith('firstname'):
+            continue
+        pieces = line.strip().title().split(',')
+        name = pieces[0]
+        nicks = pieces[1:]
+        for nick in nicks:
+            yield nick_record(name, nick)
+
+
+@source_parser('onyxrev')
+def parse_onyxrev(path):
+    for line in open(path):
+        if line.startswith('id,'):
+            continue
+        pieces = list(map(str.strip, line.title().split(',')))
+        name = pieces[1]
+        nick = pieces[2]
+        if name == nick:
+            continue
+        yield nick_record(name, nick)
+
+
+def parse_source(src, paths):
+    """Run the source's parser over each of its raw files, and write the combined data to its common.yaml"""
+    data = {}
+    for path in paths:
+        for name, key, value in PARSERS[src](path):
+            entry = data.setdefault(name, {})
+            if key == 'gender_flag':
+                entry[key] = entry.get(key, 0) | value
             else:
-                current_data = {}
+                # A dictionary is used as an insertion-ordered set
+                entry.setdefault(key, {})[value] = None
+
+    for entry in data.values():
+        for key, value in entry.items():
+            if isinstance(value, dict):
+                entry[key] = list(value)
+
+    with open(CACHE_FOLDER / src / 'common.yaml', 'w') as f:
+        yaml.dump(data, f)
+    save_yaml_file(CACHE_FOLDER / src / PARSED_FILENAME, raw_hashes(paths))
+    return src, data
+
+
+def group_raw_files(raw_files):
+    paths = {}
+    for src, path in raw_files:
+        paths.setdefault(src, []).append(path)
+    return paths
+
+
+def raw_hashes(paths):
+    return {path.name: file_hash(path) for path in paths}
+
+
+def needs_parse(src, paths):
+    """Whether the source's common.yaml is missing or was parsed from different raw file contents"""
+    if not (CACHE_FOLDER / src / 'common.yaml').exists():
+        return True
+    return load_yaml_file(CACHE_FOLDER / src / PARSED_FILENAME) != raw_hashes(paths)
+
 
-        if name not in current_data:
-            current_data[name] = {}
+def parse_to_common(raw_files, force=False):
+    """Return the parsed data for each source.
 
-        for src, data in common.items():
-            if name not in data:
-                continue
-            ndata = data[name]
-            for k, v in ndata.items():
-                if k not in current_data[name]:
-                    current_data[name][k] = v
-                elif k == 'gender_mask':
-                    current_data[name][k] |= v
+    Only the sources whose raw files have changed since their common.yaml was written are parsed (unless force),
+    each in its own worker. The rest are loaded from their common.yaml."""
+    paths = group_raw_files(raw_files)
 
-    if current_data is not None:
-        yaml.safe_dump(current_data, open(current_path, 'w'), allow_unicode=True)
+    to_parse = {}
+    common = {}
+    for src, src_paths in paths.items():
+        if src not in PARSERS:
+            click.secho(f'Skipping {src}', fg='yellow')
+            continue
+        if force or needs_parse(src, src_paths):
+            to_parse[src] = src_paths
+        else:
+            common[src] = yaml.load(open(CACHE_FOLDER / src / 'common.yaml'), Loader=YAML_LOADER)
+
+    if to_parse:
+        click.secho(f'Parsing {", ".join(to_parse)}', fg='blue')
+        with multiprocessing.Pool(len(to_parse)) as pool:
+            common.update(pool.starmap(parse_source, to_parse.items()))
+
+    # Keep the order of the sources consistent, since the earlier sources take precedence in integrate
+    return {src: common[src] for src in paths if src in common}
+
+
+def iter_source(index, data):
+    """Yield (bucket, name, index, entry) for each of the source's entries, sorted by bucket and name"""
+    names = list(data)
+    for bucket, name in sorted(zip(get_buckets(names), names)):
+        yield bucket, name, index, data[name]
+
+
+def update_entry(current_data, name, entries):
+    """Merge each source's entry for the name into the existing data.
+
+    The gender flags are OR'ed together. For the other fields, existing values take precedence,
+    followed by the sources in order."""
+    if name not in current_data:
+        current_data[name] = {}
+    current = current_data[name]
+
+    for ndata in entries:
+        for k, v in ndata.items():
+            if k not in current:
+                current[k] = v
+            elif k == 'gender_flag':
+                current[k] |= v
+
+
+def integrate(common):
+    """Merge the sources into the bucket files with a k-way merge of the (bucket, name)-sorted sources,
+    so only one bucket's data is loaded at a time"""
+    merged = heapq.merge(*[iter_source(index, data) for index, data in enumerate(common.values())])
+    for bucket, bucket_rows in itertools.groupby(merged, key=operator.itemgetter(0)):
+        updates = [(name, [row[3] for row in name_rows])
+                   for name, name_rows in itertools.groupby(bucket_rows, key=operator.itemgetter(1))]
+        update_bucket(bucket, ROOT, updates, update_entry)
+
+
+def get_integrated_state(sources):
+    """The hashes of the sources' common.yaml files and of the bucket files they are integrated into"""
+    return {
+        'sources': {src: file_hash(CACHE_FOLDER / src / 'common.yaml') for src in sources},
+        'data': {path.name: file_hash(path) for path in sorted(ROOT.glob('*.yaml'))},
+    }
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-d', '--redownload', action='store_true')
+    parser.add_argument('-d', '--redownload', action='store_true',
+                        help='Check the sources for changes (only changed files are transferred)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Parse and integrate the sources even if none of the raw files changed')
+    parser.add_argument('-j', '--jobs', type=int, default=len(SOURCES), help='Number of concurrent downloads')
+    parser.add_argument('-t', '--timeout', type=float, default=60, help='Timeout (in seconds) for each request')
+    add_arguments(parser)
     args = parser.parse_args()
 
-    raw_files = download(args.redownload)
-    common = parse_to_common(raw_files)
-    integrate(common)
+    with instrument('update_misc_sources', args):
+        with timer('stage.download'):
+            raw_files, changed, validators = download(args.redownload, args.jobs, args.timeout)
+        paths = {src: src_paths for src, src_paths in group_raw_files(raw_files).items() if src in PARSERS}
+        stale = any(needs_parse(src, src_paths) for src, src_paths in paths.items())
+        # The bucket files are also rewritten by the other pipelines, which may drop the integrated data
+        if not changed and not stale and not args.force and \
+                load_yaml_file(INTEGRATED_PATH) == get_integrated_state(paths):
+            click.secho('No sources or bucket files have changed', fg='green')
+        else:
+            with timer('stage.parse'):
+                common = parse_to_common(raw_files, args.force)
+            with timer('stage.integrate'), hot_loop():
+                integrate(common)
+            save_yaml_file(INTEGRATED_PATH, get_integrated_state(common))
+        save_validators(validators)
@@ -0,0 +1,13 @@
+from metro_db import MetroDB
+import pathlib
+
+from wiktionary import Relationship
+
+DB_FOLDER = pathlib.Path('db')
+DATA_FOLDER = pathlib.Path('data')
+
+
+class NamesDB(MetroDB):
+    def __init__(self, folder=DB_FOLDER, **kwargs):
+        MetroDB.__init__(self, 'names', folder=folder, enums_to_register=[Relationship], **kwargs)
+        self.load_yaml(folder / 'names.yaml')
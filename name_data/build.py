@@ -0,0 +1,249 @@
+import argparse
+import click
+import multiprocessing
+import pathlib
+from tqdm import tqdm
+import yaml
+
+from buckets import file_hash, get_buckets, load_bucket_file
+from instrumentation import add_arguments, hot_loop, instrument, timer
+from wiktionary import Relationship
+from . import NamesDB, DATA_FOLDER
+from .equivalence import build_equivalence, DEFAULT_RELATIONSHIPS
+from .fuzzy import build_name_keys
+from .snapshot import write_snapshot, SNAPSHOT_PATH
+
+# Created after the data is loaded
+INDEXES = {
+    'names_name': 'names(name)',
+    'names_folded_name': 'names(folded_name)',
+    'languages_name_id': 'languages(name_id)',
+    'origins_name_id': 'origins(name_id)',
+    'relationships_name_id': 'relationships(name_id)',
+    'relationships_name_id2': 'relationships(name_id2)',
+    'equivalence_name_id': 'equivalence(name_id)',
+    'equivalence_component_id': 'equivalence(component_id)',
+    'name_keys_folded_key': 'name_keys(folded_key)',
+    'name_keys_phonetic_key': 'name_keys(phonetic_key)',
+}
+
+BUILD_PRAGMAS = [
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -200000',
+]
+
+
+def create_indexes(db):
+    for index_name, index_s in INDEXES.items():
+        db.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {index_s}')
+
+
+def build_serial(db, data_paths):
+    """Build the database one row at a time with the MetroDB row API"""
+    name_to_id = {}
+
+    bar = tqdm(data_paths)
+
+    for data_path in bar:
+        bar.set_description(f'{data_path.stem:20}')
+        data = yaml.safe_load(open(data_path))
+        for name, ndata in sorted(data.items()):
+            entry = {'name': name, 'folded_name': name.casefold()}
+            if ndata.get('gender_flag'):
+                entry['gender_flag'] = ndata['gender_flag']
+                ndata.pop('gender_flag')
+
+            if name in name_to_id:
+                name_id = name_to_id[name]
+                if 'gender_flag' in entry:
+                    entry['id'] = name_id
+                    db.update('names', entry)
+            else:
+                name_id = db.insert('names', entry)
+                name_to_id[name] = name_id
+
+            for field, table_name in [('lang', 'languages'), ('origin', 'origins')]:
+                if field not in ndata:
+                    continue
+                for language in ndata[field]:
+                    db.insert(table_name, {'name_id': name_id, 'language': language})
+                ndata.pop(field)
+
+            for key in sorted(ndata.keys()):
+                rel = Relationship[key.upper()]
+                if not rel:
+                    continue
+                for other_name in ndata.pop(key):
+                    if other_name in name_to_id:
+                        name_id2 = name_to_id[other_name]
+                    else:
+                        name_id2 = db.insert('names', {'name': other_name, 'folded_name': other_name.casefold()})
+                        name_to_id[other_name] = name_id2
+                    db.insert('relationships', {'name_id': name_id, 'relationship': rel, 'name_id2': name_id2})
+            if ndata:
+                raise RuntimeError(f'Unknown fields for {name}: {ndata}')
+
+
+class RowBuilder:
+    """Converts the bucket data into rows, assigning ids to new names in memory"""
+
+    def __init__(self, name_to_id=None):
+        self.name_to_id = dict(name_to_id or {})
+        self.next_id = max(self.name_to_id.values(), default=0) + 1
+        self.new_names = []
+        self.gender_updates = []
+        self.rows = {'languages': [], 'origins': [], 'relationships': []}
+
+    def get_id(self, name):
+        if name not in self.name_to_id:
+            self.name_to_id[name] = self.next_id
+            self.new_names.append([self.next_id, name, None, name.casefold()])
+            self.next_id += 1
+        return self.name_to_id[name]
+
+    def add_bucket(self, data):
+        for name, ndata in sorted(data.items()):
+            ndata = dict(ndata)
+            gender_flag = ndata.pop('gender_flag', None)
+
+            is_new = name not in self.name_to_id
+            name_id = self.get_id(name)
+            if gender_flag:
+                if is_new:
+                    self.new_names[-1][2] = gender_flag
+                else:
+                    self.gender_updates.append((gender_flag, name_id))
+
+            for field, table_name in [('lang', 'languages'), ('origin', 'origins')]:
+                for language in ndata.pop(field, []):
+                    self.rows[table_name].append((name_id, language))
+
+            for key in sorted(ndata.keys()):
+                rel = Relationship[key.upper()]
+                for other_name in ndata.pop(key):
+                    self.rows['relationships'].append((name_id, rel, self.get_id(other_name)))
+
+    def write(self, db):
+        db.bulk_insert('names', ['id', 'name', 'gender_flag', 'folded_name'], self.new_names)
+        db.execute_many('UPDATE names SET gender_flag=? WHERE id=?', self.gender_updates)
+        db.bulk_insert('languages', ['name_id', 'language'], self.rows['languages'])
+        db.bulk_insert('origins', ['name_id', 'language'], self.rows['origins'])
+        db.bulk_insert('relationships', ['name_id', 'relationship', 'name_id2'], self.rows['relationships'])
+
+
+def load_data(data_paths, jobs):
+    with multiprocessing.Pool(jobs) as pool:
+        return pool.map(load_bucket_file, data_paths)
+
+
+def build_bulk(db, data_paths, jobs):
+    """Build the database by parsing the bucket files in parallel, assigning ids in memory
+    and writing each table with a single executemany.
+
+    Produces exactly the same rows as build_serial."""
+    builder = RowBuilder()
+    for data in tqdm(load_data(data_paths, jobs)):
+        builder.add_bucket(data)
+
+    for pragma in BUILD_PRAGMAS:
+        db.execute(pragma)
+    builder.write(db)
+
+
+def write_manifest(db, hashes):
+    db.execute('DELETE FROM sources')
+    db.bulk_insert('sources', ['filename', 'content_hash'], sorted(hashes.items()))
+
+
+def backfill_folded_names(db):
+    """Fill in folded_name for the names inserted before the column was added"""
+    rows = db.execute('SELECT id, name FROM names WHERE folded_name IS NULL').fetchall()
+    db.execute_many('UPDATE names SET folded_name=? WHERE id=?', [(name.casefold(), name_id) for name_id, name in rows])
+    return len(rows)
+
+
+def build_incremental(db, data_paths, jobs):
+    """Only delete and reinsert the rows from the bucket files that changed since the last build.
+
+    Existing names keep their ids (including names that are no longer referenced by any bucket)"""
+    backfilled = backfill_folded_names(db)
+    if backfilled:
+        click.secho(f'Filled in folded_name for {backfilled} names', fg='bright_blue')
+
+    manifest = db.dict_lookup('filename', 'content_hash', 'sources')
+    hashes = {path.name: file_hash(path) for path in data_paths}
+    changed_paths = [path for path in data_paths if manifest.get(path.name) != hashes[path.name]]
+    changed_buckets = {pathlib.Path(filename).stem for filename in set(manifest) - set(hashes)}
+    changed_buckets.update(path.stem for path in changed_paths)
+    if not changed_buckets:
+        click.secho('No bucket files have changed', fg='green')
+        return
+    click.secho(f'Rebuilding {", ".join(sorted(changed_buckets))}', fg='bright_blue')
+
+    # Clear out the rows for every entry that lives in one of the changed buckets, or that is now in one of the
+    # changed files (in case it was moved there from a file that isn't its bucket)
+    changed_data = load_data(changed_paths, jobs)
+    name_to_id = db.dict_lookup('name', 'id', 'names')
+    names = list(name_to_id)
+    stale_names = {name for name, bucket in zip(names, get_buckets(names)) if '_'.join(bucket) in changed_buckets}
+    for data in changed_data:
+        stale_names.update(name for name in data if name in name_to_id)
+    stale_ids = [(name_to_id[name],) for name in sorted(stale_names)]
+    for table in ['languages', 'origins', 'relationships']:
+        db.execute_many(f'DELETE FROM {table} WHERE name_id=?', stale_ids)
+    db.execute_many('UPDATE names SET gender_flag=NULL WHERE id=?', stale_ids)
+
+    builder = RowBuilder(name_to_id)
+    for data in changed_data:
+        builder.add_bucket(data)
+    builder.write(db)
+    write_manifest(db, hashes)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='Number of processes to parse the bucket files with')
+    parser.add_argument('--serial', action='store_true', help='Insert one row at a time (slow, implies --full)')
+    parser.add_argument('-f', '--full', action='store_true',
+                        help='Rebuild everything, instead of just the rows from bucket files that have changed')
+    parser.add_argument('-e', '--equivalence', nargs='+', metavar='RELATIONSHIP',
+                        default=[rel.name.lower() for rel in DEFAULT_RELATIONSHIPS],
+                        choices=[rel.name.lower() for rel in Relationship],
+                        help='Relationship types that link names into the same equivalence class')
+    parser.add_argument('--distances', action='store_true',
+                        help='Also store the number of hops from each name to its equivalence class id')
+    parser.add_argument('-s', '--snapshot', action='store_true',
+                        help=f'Also export a memory-mappable binary snapshot to {SNAPSHOT_PATH}')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrument('build_db', args):
+        db = NamesDB()
+        db.update_database_structure()
+
+        data_paths = sorted(DATA_FOLDER.glob('*yaml'))
+        with timer('stage.load'), hot_loop():
+            if not args.full and not args.serial and db.count('sources'):
+                build_incremental(db, data_paths, args.jobs)
+            else:
+                db.reset()
+                if args.serial:
+                    build_serial(db, data_paths)
+                else:
+                    build_bulk(db, data_paths, args.jobs)
+                write_manifest(db, {path.name: file_hash(path) for path in data_paths})
+
+        with timer('stage.equivalence'):
+            relationships = [Relationship[key.upper()] for key in args.equivalence]
+            num_components = build_equivalence(db, relationships, args.distances)
+        click.secho(f'{num_components} equivalence classes', fg='bright_blue')
+        with timer('stage.indexes'):
+            build_name_keys(db)
+            create_indexes(db)
+        if args.snapshot:
+            size = write_snapshot(db)
+            click.secho(f'Wrote {size / 2**20:.1f} MiB snapshot to {SNAPSHOT_PATH}', fg='bright_blue')
+        db.close()
@@ -0,0 +1,63 @@
+import collections
+
+from wiktionary import Relationship
+
+DEFAULT_RELATIONSHIPS = [Relationship.IS_SHORT_FOR, Relationship.IS_A_VARIANT_OF, Relationship.IS_EQUIVALENT_TO]
+
+
+def find_components(name_ids, edges):
+    """Union-find over the (undirected) edges. Returns a dictionary mapping each name id to its component id,
+    which is the smallest name id in the component"""
+    parent = {name_id: name_id for name_id in name_ids}
+
+    def find(name_id):
+        root = name_id
+        while parent[root] != root:
+            root = parent[root]
+        while parent[name_id] != root:
+            parent[name_id], name_id = root, parent[name_id]
+        return root
+
+    for a, b in edges:
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    return {name_id: find(name_id) for name_id in parent}
+
+
+def find_distances(components, edges):
+    """Breadth-first search from each component id, returning the number of hops to each name"""
+    neighbors = collections.defaultdict(list)
+    for a, b in edges:
+        neighbors[a].append(b)
+        neighbors[b].append(a)
+
+    distances = {}
+    for component_id in set(components.values()):
+        distances[component_id] = 0
+        queue = collections.deque([component_id])
+        while queue:
+            name_id = queue.popleft()
+            for other_id in neighbors[name_id]:
+                if other_id not in distances:
+                    distances[other_id] = distances[name_id] + 1
+                    queue.append(other_id)
+    return distances
+
+
+def build_equivalence(db, relationships=DEFAULT_RELATIONSHIPS, distances=False):
+    """Rewrite the equivalence table, assigning each name to the connected component it belongs to
+    when only following the given relationship types"""
+    name_ids = [row['id'] for row in db.query('SELECT id FROM names')]
+    rel_s = ', '.join(str(int(rel)) for rel in relationships)
+    edges = [(row['name_id'], row['name_id2'])
+             for row in db.query(f'SELECT name_id, name_id2 FROM relationships WHERE relationship IN ({rel_s})')]
+
+    components = find_components(name_ids, edges)
+    hops = find_distances(components, edges) if distances else {}
+
+    db.execute('DELETE FROM equivalence')
+    db.bulk_insert('equivalence', ['name_id', 'component_id', 'distance'],
+                   [(name_id, component_id, hops.get(name_id)) for name_id, component_id in components.items()])
+    return len(set(components.values()))
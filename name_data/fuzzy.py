@@ -0,0 +1,158 @@
+import collections
+from unidecode import unidecode
+
+from . import NamesDB
+
+# Each name is split into n-grams of this length (after padding) for candidate generation
+GRAM_SIZE = 2
+SOUNDEX_CODES = {}
+for letters, code in [('BFPV', '1'), ('CGJKQSXZ', '2'), ('DT', '3'), ('L', '4'), ('MN', '5'), ('R', '6')]:
+    for letter in letters:
+        SOUNDEX_CODES[letter] = code
+
+Match = collections.namedtuple('Match', ['name', 'distance', 'phonetic', 'via'])
+
+
+def fold_name(name):
+    """Transliterate to ascii and drop everything that isn't a letter"""
+    return ''.join(c for c in unidecode(name).casefold() if c.isalpha())
+
+
+def phonetic_key(folded):
+    """American Soundex of an already folded name"""
+    if not folded:
+        return ''
+    letters = folded.upper()
+    key = letters[0]
+    last = SOUNDEX_CODES.get(letters[0])
+    for letter in letters[1:]:
+        code = SOUNDEX_CODES.get(letter)
+        if code and code != last:
+            key += code
+            if len(key) == 4:
+                break
+        if letter not in 'HW':
+            last = code
+    return key.ljust(4, '0')
+
+
+def get_grams(folded):
+    padded = '^' + folded + '$'
+    return {padded[i:i + GRAM_SIZE] for i in range(len(padded) - GRAM_SIZE + 1)}
+
+
+def edit_distance(a, b, max_distance):
+    """Levenshtein distance between a and b, or max_distance + 1 if it is larger than max_distance"""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return min(previous[-1], max_distance + 1)
+
+
+def compute_keys(names):
+    """Return rows of (name_id, folded_key, phonetic_key) for the given {name_id: name} dictionary"""
+    rows = []
+    for name_id, name in names.items():
+        folded = fold_name(name)
+        rows.append((name_id, folded, phonetic_key(folded)))
+    return rows
+
+
+def build_name_keys(db):
+    """Rewrite the name_keys table that the FuzzyIndex is loaded from"""
+    rows = compute_keys(db.dict_lookup('id', 'name', 'names'))
+    db.execute('DELETE FROM name_keys')
+    db.bulk_insert('name_keys', ['name_id', 'folded_key', 'phonetic_key'], rows)
+
+
+class FuzzyIndex:
+    """In-memory index for approximate name lookups.
+
+    Candidates are the names with the same folded key, the same phonetic key, or enough n-grams in common
+    with the folded key to possibly be within the edit distance. They are ranked by the edit distance
+    between folded keys, with a phonetic match counting as one less edit."""
+
+    def __init__(self, rows, names):
+        self.names = names
+        self.folded = {}
+        self.phonetic = {}
+        self.by_folded = collections.defaultdict(list)
+        self.by_phonetic = collections.defaultdict(list)
+        self.by_gram = collections.defaultdict(list)
+        self.by_length = collections.defaultdict(list)
+        for name_id, folded, phonetic in rows:
+            self.folded[name_id] = folded
+            self.phonetic[name_id] = phonetic
+            self.by_folded[folded].append(name_id)
+            if phonetic:
+                self.by_phonetic[phonetic].append(name_id)
+            # Partitioned by length, since only names of similar length can be within the edit distance
+            self.by_length[len(folded)].append(name_id)
+            for gram in get_grams(folded):
+                self.by_gram[gram, len(folded)].append(name_id)
+
+    @classmethod
+    def from_db(cls, db=None):
+        db = db or NamesDB()
+        names = db.dict_lookup('id', 'name', 'names')
+        if db.count('name_keys'):
+            rows = [(row['name_id'], row['folded_key'], row['phonetic_key'])
+                    for row in db.query('SELECT * FROM name_keys')]
+        else:
+            rows = compute_keys(names)
+        return cls(rows, names)
+
+    def candidates(self, folded, max_distance):
+        grams = get_grams(folded)
+        # Each edit changes at most GRAM_SIZE grams
+        min_shared = len(grams) - GRAM_SIZE * max_distance
+        lengths = range(len(folded) - max_distance, len(folded) + max_distance + 1)
+        if min_shared <= 0:
+            # Too short for the filter to rule anything out, so every name of a similar length is a candidate
+            return {name_id for length in lengths for name_id in self.by_length.get(length, ())}
+        counts = collections.Counter()
+        for length in lengths:
+            for gram in grams:
+                counts.update(self.by_gram.get((gram, length), ()))
+        return {name_id for name_id, count in counts.items() if count >= min_shared}
+
+    def lookup(self, name, k=10, max_distance=2, equivalents=None):
+        """Return up to k Matches for name, best first.
+
+        If equivalents is given, it is called with the list of matched names and should return a dictionary of
+        related names for each (i.e. NameQuery.equivalents_of or NameQuery.nicknames_of). The related names
+        are included as well, with the via field set to the name they were found through"""
+        folded = fold_name(name)
+        phonetic = phonetic_key(folded)
+        name_ids = self.candidates(folded, max_distance)
+        name_ids.update(self.by_folded.get(folded, ()))
+        name_ids.update(self.by_phonetic.get(phonetic, ()))
+
+        scored = []
+        for name_id in name_ids:
+            is_phonetic = bool(phonetic) and phonetic == self.phonetic[name_id]
+            distance = edit_distance(folded, self.folded[name_id], max_distance)
+            if distance <= max_distance or is_phonetic:
+                scored.append((distance - is_phonetic, distance, self.names[name_id], is_phonetic))
+        scored.sort()
+        matches = [Match(name, distance, is_phonetic, None) for _, distance, name, is_phonetic in scored[:k]]
+
+        if equivalents is None:
+            return matches
+
+        seen = {match.name for match in matches}
+        expanded = list(matches)
+        related = equivalents([match.name for match in matches])
+        for match in matches:
+            for other_name in related[match.name]:
+                if other_name not in seen:
+                    seen.add(other_name)
+                    expanded.append(Match(other_name, match.distance, match.phonetic, match.name))
+        return expanded
@@ -0,0 +1,81 @@
+import collections
+
+from buckets import get_bucket, get_buckets, get_bucket_path, load_bucket_file
+from . import DATA_FOLDER
+
+# Measured in bytes of yaml on disk, which is a stable proxy for the size of the parsed data
+DEFAULT_MAX_BYTES = 2**20
+
+
+class BucketLoader:
+    """Looks up names in the bucket files, parsing each file only when a name in it is first needed.
+
+    Parsed buckets are kept in an LRU cache. Once the sizes of the cached files add up to more than max_bytes,
+    the least recently used buckets are evicted. The most recent bucket is always kept, even if it is bigger
+    than max_bytes on its own."""
+
+    def __init__(self, root=DATA_FOLDER, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.cache = collections.OrderedDict()
+        self.sizes = {}
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, bucket):
+        """Return the data for the bucket, which is empty if it has no file"""
+        if bucket in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(bucket)
+            return self.cache[bucket]
+
+        self.misses += 1
+        path = get_bucket_path(bucket, self.root)
+        if path.exists():
+            size = path.stat().st_size
+            data = load_bucket_file(path) or {}
+        else:
+            size = 0
+            data = {}
+
+        self.cache[bucket] = data
+        self.sizes[bucket] = size
+        self.cached_bytes += size
+        while self.cached_bytes > self.max_bytes and len(self.cache) > 1:
+            evicted, _ = self.cache.popitem(last=False)
+            self.cached_bytes -= self.sizes.pop(evicted)
+        return data
+
+    def get(self, name, default=None):
+        return self.load(get_bucket(name)).get(name, default)
+
+    def __getitem__(self, name):
+        data = self.load(get_bucket(name))
+        if name not in data:
+            raise KeyError(name)
+        return data[name]
+
+    def __contains__(self, name):
+        return name in self.load(get_bucket(name))
+
+    def get_many(self, names):
+        """Return a dictionary of the data for each of the names that are in the bucket files.
+
+        The names are grouped by bucket so that each bucket is loaded once, no matter the order of the names"""
+        by_bucket = collections.defaultdict(list)
+        for name, bucket in zip(names, get_buckets(names)):
+            by_bucket[bucket].append(name)
+
+        results = {}
+        for bucket, bucket_names in by_bucket.items():
+            data = self.load(bucket)
+            for name in bucket_names:
+                if name in data:
+                    results[name] = data[name]
+        return results
+
+    def clear(self):
+        self.cache.clear()
+        self.sizes.clear()
+        self.cached_bytes = 0
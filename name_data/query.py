@@ -0,0 +1,133 @@
+import collections
+import contextlib
+import queue
+import sqlite3
+
+from wiktionary import Relationship
+from . import DB_FOLDER
+
+# Each batch is padded to this size so that the same prepared statement is reused
+BATCH_SIZE = 256
+
+RELATED_QUERY = """SELECT query.{key_field}, other.name FROM names AS query
+    JOIN relationships ON relationships.{query_id} == query.id
+    JOIN names AS other ON relationships.{other_id} == other.id
+    WHERE relationships.relationship == ? AND query.{key_field} IN ({placeholders})"""
+
+COMPONENT_QUERY = """SELECT {key_field}, component_id FROM names
+    JOIN equivalence ON equivalence.name_id == names.id
+    WHERE {key_field} IN ({placeholders})"""
+
+EQUIVALENTS_QUERY = """SELECT component_id, name FROM equivalence
+    JOIN names ON equivalence.name_id == names.id
+    WHERE component_id IN ({placeholders})"""
+
+LANGUAGE_QUERY = """SELECT language, name, gender_flag FROM languages
+    JOIN names ON languages.name_id == names.id
+    WHERE language IN ({placeholders})"""
+
+
+class ConnectionPool:
+    """A fixed-size pool of read-only connections that can be shared between threads"""
+
+    def __init__(self, path=DB_FOLDER / 'names.db', size=4):
+        self.connections = queue.Queue()
+        for _ in range(size):
+            conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+            self.connections.put(conn)
+        self.size = size
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.connections.get()
+        try:
+            yield conn
+        finally:
+            self.connections.put(conn)
+
+    def close(self):
+        for _ in range(self.size):
+            self.connections.get().close()
+
+
+class NameQuery:
+    """Batch lookups against names.db.
+
+    Every method takes a list of keys, and returns a dictionary mapping each key to a sorted list of names.
+    With folded=True, the names are matched case-insensitively (using str.casefold)."""
+
+    def __init__(self, pool=None):
+        self.pool = pool or ConnectionPool()
+
+    def run_batched(self, query, keys, params=()):
+        query = query.format(placeholders=', '.join(['?'] * BATCH_SIZE))
+        keys = list(keys)
+        rows = []
+        with self.pool.connection() as conn:
+            for i in range(0, len(keys), BATCH_SIZE):
+                batch = keys[i:i + BATCH_SIZE]
+                batch += [None] * (BATCH_SIZE - len(batch))
+                rows += conn.execute(query, list(params) + batch).fetchall()
+        return rows
+
+    def related(self, names, relationship, reverse=False, folded=False):
+        """Find the names where `name relationship other`, or `other relationship name` if reversed"""
+        key_field = 'folded_name' if folded else 'name'
+        query_id, other_id = ('name_id2', 'name_id') if reverse else ('name_id', 'name_id2')
+        query = RELATED_QUERY.format(key_field=key_field, query_id=query_id, other_id=other_id,
+                                     placeholders='{placeholders}')
+
+        keys = collections.defaultdict(list)
+        for name in names:
+            keys[name.casefold() if folded else name].append(name)
+
+        results = {name: set() for name in names}
+        for key, other_name in self.run_batched(query, keys, [int(relationship)]):
+            for name in keys[key]:
+                results[name].add(other_name)
+        return {name: sorted(others) for name, others in results.items()}
+
+    def nicknames_of(self, names, folded=False):
+        return self.related(names, Relationship.IS_SHORT_FOR, reverse=True, folded=folded)
+
+    def formal_names_for(self, names, folded=False):
+        return self.related(names, Relationship.IS_SHORT_FOR, folded=folded)
+
+    def component_ids(self, names, folded=False):
+        """Return a dictionary mapping each name to the sorted ids of its equivalence classes (empty if it is unknown).
+
+        A name is in at most one class, but with folded=True every name that folds to the same key is matched
+        (i.e. Mar and MAR), and each of those may be in a different class."""
+        key_field = 'folded_name' if folded else 'name'
+        query = COMPONENT_QUERY.format(key_field=key_field, placeholders='{placeholders}')
+        keys = {name: name.casefold() if folded else name for name in names}
+        found = collections.defaultdict(set)
+        for key, component_id in self.run_batched(query, set(keys.values())):
+            found[key].add(component_id)
+        return {name: sorted(found.get(key, ())) for name, key in keys.items()}
+
+    def are_equivalent(self, pairs, folded=False):
+        """Return a list with whether each pair of names shares an equivalence class"""
+        pairs = list(pairs)
+        components = self.component_ids({name for pair in pairs for name in pair}, folded=folded)
+        return [a == b or not set(components[a]).isdisjoint(components[b]) for a, b in pairs]
+
+    def equivalents_of(self, names, folded=False):
+        """Find all the names in the same equivalence classes as each name, including the name itself.
+
+        Names that are not in the database have no equivalence class, so they get an empty list."""
+        components = self.component_ids(names, folded=folded)
+        all_ids = {component_id for component_ids in components.values() for component_id in component_ids}
+        members = collections.defaultdict(list)
+        for component_id, name in self.run_batched(EQUIVALENTS_QUERY, all_ids):
+            members[component_id].append(name)
+        return {name: sorted({member for component_id in component_ids for member in members[component_id]})
+                for name, component_ids in components.items()}
+
+    def names_by_language(self, languages, gender_flag=None):
+        """Find all the names for each language, optionally limited to names that match any bit of gender_flag"""
+        results = {language: set() for language in languages}
+        for language, name, name_gender in self.run_batched(LANGUAGE_QUERY, results):
+            if gender_flag is None or (name_gender or 0) & gender_flag:
+                results[language].add(name)
+        return {language: sorted(names) for language, names in results.items()}
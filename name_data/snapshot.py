@@ -0,0 +1,195 @@
+"""A compact binary snapshot of names.db that can be memory-mapped without parsing.
+
+All integers are little-endian. The file starts with a header:
+
+    magic (8 bytes), version (u32), number of sections (u32)
+
+followed by one entry per section:
+
+    key (8 bytes, space padded), offset (u64), length (u64)
+
+Every section starts on an 8 byte boundary so it can be cast directly to an array.
+Names are stored in sorted (utf-8 byte) order, and are referred to by their index in that order.
+
+ * names / name_off: the utf-8 strings, and the start offset of each of them (n + 1 u32s)
+ * genders: the gender_flag of each name (n u8s)
+ * langs / lang_off: the interned language codes, in the same format as the names
+ * lang_ptr / lang_idx: languages of each name in CSR form. The languages of name i are
+   lang_idx[lang_ptr[i]:lang_ptr[i + 1]] (n + 1 u32s and u16s)
+ * orig_ptr / orig_idx: origins of each name, in the same format
+ * rel_ptr / rel_dst / rel_type: relationships of each name in CSR form (n + 1 u32s, u32s and u8s)
+"""
+import mmap
+import struct
+import sys
+
+from wiktionary import Relationship
+from . import DB_FOLDER
+
+SNAPSHOT_PATH = DB_FOLDER / 'names.snapshot'
+MAGIC = b'NAMESNAP'
+VERSION = 1
+HEADER = struct.Struct('<8sII')
+SECTION = struct.Struct('<8sQQ')
+# Array typecode for each section
+SECTION_TYPES = {
+    'names': 'B', 'name_off': 'I', 'genders': 'B',
+    'langs': 'B', 'lang_off': 'I',
+    'lang_ptr': 'I', 'lang_idx': 'H',
+    'orig_ptr': 'I', 'orig_idx': 'H',
+    'rel_ptr': 'I', 'rel_dst': 'I', 'rel_type': 'B',
+}
+
+
+def pack_strings(strings):
+    """Return the concatenated utf-8 blob and the n + 1 offsets into it"""
+    encoded = [s.encode() for s in strings]
+    offsets = [0]
+    for s in encoded:
+        offsets.append(offsets[-1] + len(s))
+    return b''.join(encoded), offsets
+
+
+def pack_csr(rows_per_name, n):
+    """Convert a {index: [values]} dictionary into the pointer and value arrays"""
+    ptr = [0]
+    values = []
+    for i in range(n):
+        values += rows_per_name.get(i, [])
+        ptr.append(len(values))
+    return ptr, values
+
+
+def write_snapshot(db, path=SNAPSHOT_PATH):
+    id_to_name = db.dict_lookup('id', 'name', 'names')
+    names = sorted(id_to_name.values(), key=lambda name: name.encode())
+    index = {name: i for i, name in enumerate(names)}
+    id_to_index = {name_id: index[name] for name_id, name in id_to_name.items()}
+
+    genders = [0] * len(names)
+    for row in db.query('SELECT id, gender_flag FROM names WHERE gender_flag IS NOT NULL'):
+        genders[id_to_index[row['id']]] = row['gender_flag']
+
+    langs = sorted({row['language'] for row in db.query('SELECT language FROM languages UNION '
+                                                        'SELECT language FROM origins')})
+    lang_index = {lang: i for i, lang in enumerate(langs)}
+
+    csr = {}
+    for key, table in [('lang', 'languages'), ('orig', 'origins')]:
+        rows = {}
+        for row in db.query(f'SELECT name_id, language FROM {table}'):
+            rows.setdefault(id_to_index[row['name_id']], []).append(lang_index[row['language']])
+        csr[key] = pack_csr({i: sorted(values) for i, values in rows.items()}, len(names))
+
+    rels = {}
+    for row in db.query('SELECT name_id, relationship, name_id2 FROM relationships'):
+        value = (id_to_index[row['name_id2']], int(row['relationship']))
+        rels.setdefault(id_to_index[row['name_id']], []).append(value)
+    rel_ptr, rel_values = pack_csr({i: sorted(set(values)) for i, values in rels.items()}, len(names))
+
+    name_blob, name_off = pack_strings(names)
+    lang_blob, lang_off = pack_strings(langs)
+    arrays = {
+        'names': name_blob, 'name_off': name_off, 'genders': genders,
+        'langs': lang_blob, 'lang_off': lang_off,
+        'lang_ptr': csr['lang'][0], 'lang_idx': csr['lang'][1],
+        'orig_ptr': csr['orig'][0], 'orig_idx': csr['orig'][1],
+        'rel_ptr': rel_ptr, 'rel_dst': [dst for dst, _ in rel_values], 'rel_type': [rel for _, rel in rel_values],
+    }
+
+    offset = HEADER.size + SECTION.size * len(arrays)
+    header = [HEADER.pack(MAGIC, VERSION, len(arrays))]
+    body = []
+    for key, values in arrays.items():
+        typecode = SECTION_TYPES[key]
+        data = values if isinstance(values, bytes) else struct.pack(f'<{len(values)}{typecode}', *values)
+        padding = -offset % 8
+        body.append(b'\0' * padding)
+        offset += padding
+        header.append(SECTION.pack(key.encode().ljust(8), offset, len(data)))
+        body.append(data)
+        offset += len(data)
+
+    with open(path, 'wb') as f:
+        f.write(b''.join(header + body))
+    return offset
+
+
+class Snapshot:
+    """Read-only view of a snapshot file.
+
+    The file is mapped (not read) into memory and the arrays are views onto the mapping, so opening is
+    nearly free, and processes forked after opening share the same pages."""
+
+    def __init__(self, path=SNAPSHOT_PATH):
+        if sys.byteorder != 'little':
+            raise RuntimeError('Snapshots can only be memory-mapped on little-endian machines')
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.mmap)
+
+        magic, version, num_sections = HEADER.unpack_from(view)
+        if magic != MAGIC or version != VERSION:
+            raise RuntimeError(f'{path} is not a version {VERSION} snapshot')
+
+        self.arrays = {}
+        for i in range(num_sections):
+            key, offset, length = SECTION.unpack_from(view, HEADER.size + i * SECTION.size)
+            key = key.decode().strip()
+            self.arrays[key] = view[offset:offset + length].cast(SECTION_TYPES[key])
+        for key, array in self.arrays.items():
+            setattr(self, key, array)
+
+    def __len__(self):
+        return len(self.genders)
+
+    def close(self):
+        for array in self.arrays.values():
+            array.release()
+        self.arrays = {}
+        self.mmap.close()
+
+    def name(self, i):
+        return bytes(self.names[self.name_off[i]:self.name_off[i + 1]]).decode()
+
+    def lang(self, i):
+        return bytes(self.langs[self.lang_off[i]:self.lang_off[i + 1]]).decode()
+
+    def find(self, name):
+        """Binary search for the index of name, or None if it is not in the snapshot"""
+        target = name.encode()
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if bytes(self.names[self.name_off[mid]:self.name_off[mid + 1]]) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self.names[self.name_off[lo]:self.name_off[lo + 1]] == target:
+            return lo
+
+    def languages(self, i):
+        return [self.lang(j) for j in self.lang_idx[self.lang_ptr[i]:self.lang_ptr[i + 1]]]
+
+    def origins(self, i):
+        return [self.lang(j) for j in self.orig_idx[self.orig_ptr[i]:self.orig_ptr[i + 1]]]
+
+    def relationships(self, i):
+        start, end = self.rel_ptr[i], self.rel_ptr[i + 1]
+        return [(Relationship(rel), self.name(dst))
+                for dst, rel in zip(self.rel_dst[start:end], self.rel_type[start:end])]
+
+    def lookup(self, name):
+        """Return the data for the name in the same format as the bucket files, or None if it is missing"""
+        i = self.find(name)
+        if i is None:
+            return None
+        entry = {}
+        if self.genders[i]:
+            entry['gender_flag'] = self.genders[i]
+        for key, values in [('lang', self.languages(i)), ('origin', self.origins(i))]:
+            if values:
+                entry[key] = values
+        for rel, other_name in self.relationships(i):
+            entry.setdefault(rel.name.lower(), []).append(other_name)
+        return entry
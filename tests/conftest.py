@@ -0,0 +1,55 @@
+import http.server
+import pathlib
+import threading
+
+import pytest
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """Records each request, and answers it with the server's respond(handler) -> (status, headers, body)"""
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        status, headers, body = self.server.respond(self)
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    """Start a local HTTP server with the given respond function. The server has the url and the list of requests"""
+    servers = []
+
+    def start(respond):
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        server.respond = respond
+        server.requests = []
+        server.url = f'http://127.0.0.1:{server.server_port}/'
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def wiktionary_db(tmp_path):
+    """An empty WiktionaryDB in a temporary folder"""
+    from wiktionary import WiktionaryDB
+    db = WiktionaryDB(tmp_path)
+    db.load_yaml(pathlib.Path(__file__).parent.parent / 'wiktionary' / 'wiktionary.yaml')
+    db.update_database_structure()
+    yield db
+    db.close(print_table_sizes=False)
@@ -0,0 +1,38 @@
+import json
+import pathlib
+import sqlite3
+import sys
+
+import buckets
+from buckets import classify_letter, get_bucket, get_bucket_table, get_buckets, get_letter_bucket
+
+NAMES_DB = pathlib.Path(__file__).parent.parent / 'db' / 'names.db'
+
+
+def test_table_matches_classify_letter():
+    mismatches = [codepoint for codepoint in range(sys.maxunicode + 1)
+                  if get_letter_bucket(chr(codepoint)) != classify_letter(chr(codepoint))]
+    assert mismatches == []
+
+
+def test_names_match_classify_letter():
+    with sqlite3.connect(NAMES_DB) as conn:
+        names = [name for name, in conn.execute('SELECT name FROM names')]
+    assert names
+    expected = [classify_letter(name[0]) for name in names]
+    assert get_buckets(names) == expected
+    assert [get_bucket(name) for name in names] == expected
+
+
+def test_table_is_cached(tmp_path, monkeypatch):
+    path = tmp_path / '.bucket_table.json'
+    monkeypatch.setattr(buckets, 'BUCKET_TABLE_PATH', path)
+    monkeypatch.setattr(buckets, '_bucket_table', None)
+    starts, table = get_bucket_table()
+    assert [p.name for p in tmp_path.iterdir()] == ['.bucket_table.json']
+    assert json.loads(path.read_text())['version'] == buckets.get_bucket_table_version()
+
+    # A table from another version of the rules (or of unicodedata / unidecode) is rebuilt
+    path.write_text(json.dumps({'version': 'old', 'starts': [0], 'buckets': [['Other']]}))
+    monkeypatch.setattr(buckets, '_bucket_table', None)
+    assert get_bucket_table() == (starts, table)
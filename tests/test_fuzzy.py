@@ -0,0 +1,77 @@
+import random
+
+import pytest
+
+from name_data.fuzzy import FuzzyIndex, compute_keys, edit_distance, fold_name, phonetic_key
+
+NAMES = ['Al', 'Ann', 'Anna', 'Anne', 'Annette', 'Bob', 'Bobby', 'Jo', 'Joan', 'Joanna', 'Johann', 'Johanna', 'John',
+         'Jon', 'Jonathan', 'Nan', 'Nana', 'Nanna', 'Robert', 'Rupert', 'Zoë', 'Zoe-Ann', 'Ōta']
+
+
+def levenshtein(a, b):
+    """Unbounded Levenshtein distance, as the reference for edit_distance"""
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+def random_names(rng, count, letters='anjo', max_length=9):
+    # Few letters, so that there are many repeated n-grams and near misses
+    return [''.join(rng.choice(letters) for _ in range(rng.randint(1, max_length))) for _ in range(count)]
+
+
+def test_fold_name():
+    assert fold_name('Zoë-Ann') == 'zoeann'
+    assert fold_name("O'Neil") == 'oneil'
+    assert fold_name('Ōta') == 'ota'
+
+
+@pytest.mark.parametrize('name, key', [('Robert', 'R163'), ('Rupert', 'R163'), ('Rubin', 'R150'),
+                                       ('Ashcraft', 'A261'), ('Tymczak', 'T522'), ('Pfister', 'P236'),
+                                       ('Honeyman', 'H555'), ('Lee', 'L000'), ('', '')])
+def test_phonetic_key(name, key):
+    assert phonetic_key(fold_name(name)) == key
+
+
+def test_edit_distance_is_bounded_levenshtein():
+    rng = random.Random(0)
+    for a, b in zip(random_names(rng, 2000), random_names(rng, 2000)):
+        for max_distance in range(4):
+            assert edit_distance(a, b, max_distance) == min(levenshtein(a, b), max_distance + 1)
+
+
+@pytest.mark.parametrize('max_distance', [1, 2, 3])
+def test_lookup_finds_every_match(max_distance):
+    """The n-gram filter never drops a name that is within the edit distance"""
+    rng = random.Random(max_distance)
+    names = dict(enumerate(sorted(set(NAMES + random_names(rng, 200))), 1))
+    index = FuzzyIndex(compute_keys(names), names)
+    for query in NAMES + random_names(rng, 200):
+        folded = fold_name(query)
+        matches = {match.name: match for match in index.lookup(query, k=len(names), max_distance=max_distance)}
+        for name in names.values():
+            distance = levenshtein(folded, fold_name(name))
+            is_phonetic = phonetic_key(folded) == phonetic_key(fold_name(name)) != ''
+            if distance <= max_distance or is_phonetic:
+                assert name in matches, (query, name)
+                assert matches[name].distance == min(distance, max_distance + 1)
+                assert matches[name].phonetic == is_phonetic
+            else:
+                assert name not in matches
+
+
+def test_lookup_ranking():
+    names = dict(enumerate(NAMES, 1))
+    index = FuzzyIndex(compute_keys(names), names)
+    matches = index.lookup('Johana', k=3, max_distance=2)
+    assert [(match.name, match.distance, match.phonetic) for match in matches] == [
+        ('Johann', 1, True), ('Johanna', 1, True), ('Joan', 2, True)]
+    # Phonetic matches are included even when they are further than max_distance
+    matches = index.lookup('Robertt', k=3, max_distance=2)
+    assert [(match.name, match.distance, match.phonetic) for match in matches] == [
+        ('Robert', 1, True), ('Rupert', 3, True)]
+    assert index.lookup('Zoe', k=1)[0].name == 'Zoë'
@@ -0,0 +1,82 @@
+import bz2
+
+from wiktionary.ingest import DumpIngester, get_template_categories, iter_pages
+
+DUMP = '''<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/">
+  <page>
+    <title>Category:English male given names</title>
+    <ns>14</ns>
+    <revision><id>1</id><text>Male names</text></revision>
+  </page>
+  <page>
+    <title>John</title>
+    <ns>0</ns>
+    <revision><id>2</id><text>==English==
+[[Category:English male given names]]</text></revision>
+  </page>
+  <page>
+    <title>Jane</title>
+    <ns>0</ns>
+    <revision><id>3</id><text>==English==
+# {{given name|en|female|from=English}}</text></revision>
+  </page>
+  <page>
+    <title>Apple</title>
+    <ns>0</ns>
+    <revision><id>4</id><text>==English==
+A fruit</text></revision>
+  </page>
+  <page>
+    <title>Talk:John</title>
+    <ns>1</ns>
+    <revision><id>5</id><text>{{given name|en|male}}</text></revision>
+  </page>
+  <page>
+    <title>Zork</title>
+    <ns>0</ns>
+    <revision><id>6</id><text>{{given name|qqq|male}}</text></revision>
+  </page>
+</mediawiki>
+'''
+
+
+def write_dump(tmp_path):
+    path = tmp_path / 'pages-articles.xml.bz2'
+    path.write_bytes(bz2.compress(DUMP.encode()))
+    return path
+
+
+def test_iter_pages(tmp_path):
+    pages = list(iter_pages(write_dump(tmp_path)))
+    assert [page['title'] for page in pages] == ['Category:English male given names', 'John', 'Jane', 'Apple',
+                                                 'Talk:John', 'Zork']
+    assert pages[1]['ns'] == '0'
+    assert pages[1]['revid'] == 2
+
+
+def test_get_template_categories():
+    assert get_template_categories('{{given name|en|male|from=la|from2=grc}}') == [('en', 'male', ['la', 'grc'])]
+    assert get_template_categories('{{given name|fr}} {{given name|de|other}}') == [('fr', '', []), ('de', '', [])]
+    assert get_template_categories('{{given name|}}') == []
+
+
+def test_ingest(tmp_path, wiktionary_db):
+    ingester = DumpIngester(wiktionary_db, batch_size=2)
+    for page in iter_pages(write_dump(tmp_path)):
+        ingester.add_page(page)
+    ingester.finish()
+
+    names = wiktionary_db.dict_lookup('name', 'revid', 'names')
+    assert names == {'John': 2, 'Jane': 3, 'Zork': 6}
+    assert wiktionary_db.lookup('wiki_text', 'names', {'name': 'Jane'}).startswith('==English==')
+
+    memberships = {(row['category'], row['name']) for row in wiktionary_db.query(
+        'SELECT categories.name AS category, names.name FROM category_membership'
+        ' JOIN categories ON category_id == categories.id JOIN names ON name_id == names.id')}
+    # Jane's categories come from the {{given name}} template, using the language names of the existing categories
+    assert memberships == {
+        ('Category:English male given names', 'John'),
+        ('Category:English female given names', 'Jane'),
+        ('Category:English female given names from English', 'Jane'),
+    }
+    assert ingester.unresolved_languages == {'qqq': 1}
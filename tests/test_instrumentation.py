@@ -0,0 +1,38 @@
+import collections
+import time
+
+from metro_db.sqlite_db import SQLiteDB
+
+from instrumentation import install_hooks, metrics
+
+DELAY = 0.01
+
+
+def test_query_times_row_iteration(tmp_path, monkeypatch):
+    for attr in ['query', 'query_one', 'execute', 'execute_many']:
+        monkeypatch.setattr(SQLiteDB, attr, getattr(SQLiteDB, attr))
+    monkeypatch.setattr(metrics, 'seconds', collections.Counter())
+    monkeypatch.setattr(metrics, 'counters', collections.Counter())
+    install_hooks()
+
+    db = SQLiteDB(tmp_path / 'test.db')
+    db.raw_db.execute('CREATE TABLE numbers (n INTEGER)')
+    db.raw_db.executemany('INSERT INTO numbers VALUES (?)', [(n,) for n in range(5)])
+
+    def slow(n):
+        time.sleep(DELAY)
+        return n
+
+    # Evaluated as each row is fetched, so most of the calls happen after query has returned
+    db.raw_db.create_function('slow', 1, slow)
+    metrics.seconds.clear()
+    metrics.counters.clear()
+    results = db.query('SELECT slow(n) FROM numbers')
+    assert [row[0] for row in results] == list(range(5))
+    assert metrics.seconds['sql'] >= 5 * DELAY
+    assert metrics.counters == {'sql': 1}
+
+    # The FlexibleIterator methods that read every row still work
+    results = db.query('SELECT n FROM numbers')
+    assert len(results) == 5 and results[4][0] == 4
+    db.close()
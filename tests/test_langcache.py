@@ -0,0 +1,91 @@
+import langcodes
+import pytest
+import yaml
+
+from wiktionary import langcache
+from wiktionary.langcache import LanguageCache
+
+
+@pytest.fixture
+def find_calls(monkeypatch):
+    """Record the names passed to langcodes.find, which still does the lookups"""
+    calls = []
+    real_find = langcodes.find
+
+    def find(s):
+        calls.append(s)
+        return real_find(s)
+
+    monkeypatch.setattr(langcache.langcodes, 'find', find)
+    return calls
+
+
+def test_failed_lookups_are_cached(tmp_path, find_calls):
+    cache = LanguageCache(tmp_path / 'cache.yaml')
+    assert cache.find('English') == 'en'
+    for _ in range(2):
+        with pytest.raises(LookupError):
+            cache.find('Notalanguage')
+    assert cache.find('English') == 'en'
+    assert find_calls == ['English', 'Notalanguage']
+    assert cache.counts == {'hits': 2, 'misses': 2}
+
+    # The failure is saved too, so it is not looked up again in the next run
+    cache.save()
+    cache = LanguageCache(tmp_path / 'cache.yaml')
+    cache.load()
+    with pytest.raises(LookupError):
+        cache.find('Notalanguage')
+    assert find_calls == ['English', 'Notalanguage']
+    assert not cache.new_lookups
+
+
+def test_version_change_discards_cache(tmp_path, find_calls):
+    path = tmp_path / 'cache.yaml'
+    cache = LanguageCache(path)
+    cache.find('French')
+    cache.save()
+    assert yaml.safe_load(path.read_text()) == {'langcodes_version': cache.version, 'lookups': {'French': 'fr'}}
+
+    cache = LanguageCache(path)
+    cache.version = 'older'
+    cache.load()
+    assert cache.lookups == {}
+    assert cache.find('French') == 'fr'
+    assert find_calls == ['French', 'French']
+
+    # Saving under the new version replaces the old file
+    cache.save()
+    cache = LanguageCache(path)
+    cache.version = 'older'
+    cache.load()
+    assert cache.lookups == {'French': 'fr'}
+
+
+def test_merge_worker_caches(tmp_path, find_calls):
+    cache = LanguageCache(tmp_path / 'cache.yaml')
+    cache.find('English')
+    cache.save()
+
+    workers = []
+    for names in [['English', 'French'], ['Notalanguage', 'French']]:
+        worker = LanguageCache(tmp_path / 'cache.yaml')
+        worker.load()
+        for name in names:
+            try:
+                worker.find(name)
+            except LookupError:
+                pass
+        workers.append(worker)
+
+    for worker in workers:
+        cache.merge(worker.new_lookups, worker.counts)
+    assert cache.lookups == {'English': 'en', 'French': 'fr', 'Notalanguage': None}
+    assert cache.new_lookups == {'French': 'fr', 'Notalanguage': None}
+    assert cache.counts == {'hits': 1, 'misses': 4}
+
+    cache.save()
+    reloaded = LanguageCache(tmp_path / 'cache.yaml')
+    reloaded.load()
+    assert reloaded.lookups == cache.lookups
+    assert not (tmp_path / 'cache.yaml.tmp').exists()
@@ -0,0 +1,59 @@
+import yaml
+
+from buckets import get_bucket
+from name_data.loader import BucketLoader
+
+DATA = {
+    'Latin_A.yaml': {'Abe': {'is_short_for': ['Abraham']}},
+    'Latin_B.yaml': {'Bob': {'is_short_for': ['Robert']}},
+    'Latin_C.yaml': {'Cy': {'is_short_for': ['Cyrus']}},
+}
+
+
+def write_data(folder):
+    sizes = {}
+    for filename, data in DATA.items():
+        path = folder / filename
+        path.write_text(yaml.safe_dump(data))
+        sizes[get_bucket(next(iter(data)))] = path.stat().st_size
+    return sizes
+
+
+def test_lru_eviction(tmp_path):
+    sizes = write_data(tmp_path)
+    a, b, c = sorted(sizes)
+    # Room for any two of the buckets, but not all three
+    max_bytes = sum(sizes.values()) - min(sizes.values()) // 2
+    loader = BucketLoader(tmp_path, max_bytes=max_bytes)
+
+    assert loader['Abe'] == {'is_short_for': ['Abraham']}
+    assert 'Bob' in loader
+    assert list(loader.cache) == [a, b]
+
+    # Using A again makes B the least recently used bucket, so loading C evicts B
+    assert loader.get('Abe')
+    assert loader.get('Cy')
+    assert list(loader.cache) == [a, c]
+    assert loader.cached_bytes == sizes[a] + sizes[c] <= max_bytes
+    assert (loader.hits, loader.misses) == (1, 3)
+
+    # B is loaded from disk again, and evicts A
+    assert loader.get_many(['Bob', 'Nobody']) == {'Bob': {'is_short_for': ['Robert']}}
+    assert list(loader.cache) == [c, b, get_bucket('Nobody')]
+    assert loader.cached_bytes == sizes[b] + sizes[c]
+    assert set(loader.sizes) == set(loader.cache)
+
+
+def test_max_bytes_bound(tmp_path):
+    sizes = write_data(tmp_path)
+    loader = BucketLoader(tmp_path, max_bytes=sum(sizes.values()) // 2)
+    for name in ['Abe', 'Bob', 'Cy', 'Abe', 'Bob', 'Cy']:
+        assert name in loader
+        assert loader.cached_bytes == sum(loader.sizes[bucket] for bucket in loader.cache) <= loader.max_bytes
+    assert loader.hits == 0
+
+    # The most recent bucket is kept even when it is bigger than max_bytes on its own
+    loader = BucketLoader(tmp_path, max_bytes=1)
+    assert loader.get('Abe') and loader.get('Bob')
+    assert list(loader.cache) == [get_bucket('Bob')]
+    assert loader.cached_bytes == sizes[get_bucket('Bob')]
@@ -0,0 +1,66 @@
+import pathlib
+import sqlite3
+
+from wiktionary import WikiText, WiktionaryDB, compress_text, decompress_text
+from wiktionary.migrate import compress_pages
+
+YAML_PATH = pathlib.Path(__file__).parent.parent / 'wiktionary' / 'wiktionary.yaml'
+PAGES = {1: 'Ünïcödé\n# {{given name|en|male}}\n' * 20, 2: '# {{given name|fr|female}}'}
+
+
+def get_pages(db):
+    return {row['id']: row['wiki_text'] for row in db.query('SELECT id, wiki_text FROM names')}
+
+
+def get_storage(db):
+    return {row[0] for row in db.query('SELECT typeof(wiki_text) FROM names')}
+
+
+def test_round_trip(wiktionary_db):
+    assert decompress_text(compress_text(PAGES[1])) == PAGES[1]
+    wiktionary_db.bulk_insert('names', ['id', 'name', 'wiki_text'],
+                              [(name_id, f'Name{name_id}', WikiText(text)) for name_id, text in PAGES.items()])
+    assert get_pages(wiktionary_db) == PAGES
+    assert get_storage(wiktionary_db) == {'blob'}
+    size = wiktionary_db.query_one('SELECT length(wiki_text) FROM names WHERE id=1')[0]
+    assert size < len(PAGES[1].encode()) / 4
+
+
+def test_legacy_text_is_read_and_compressed(wiktionary_db):
+    # As stored before compression was added
+    wiktionary_db.bulk_insert('names', ['id', 'name', 'wiki_text'],
+                              [(name_id, f'Name{name_id}', text) for name_id, text in PAGES.items()])
+    assert get_storage(wiktionary_db) == {'text'}
+    assert get_pages(wiktionary_db) == PAGES
+
+    assert compress_pages(wiktionary_db, batch_size=1) == 2
+    assert get_storage(wiktionary_db) == {'blob'}
+    assert get_pages(wiktionary_db) == PAGES
+    compressed = wiktionary_db.query_one('SELECT wiki_text FROM names WHERE id=1')
+
+    # Already compressed pages are skipped
+    assert compress_pages(wiktionary_db) == 0
+    assert wiktionary_db.query_one('SELECT wiki_text FROM names WHERE id=1') == compressed
+
+
+def test_column_type_change_is_committed(tmp_path):
+    with sqlite3.connect(tmp_path / 'wiktionary.db') as conn:
+        conn.execute('CREATE TABLE names (id INTEGER PRIMARY KEY, name TEXT, wiki_text TEXT, last_crawl TIMESTAMP, '
+                     'revid INTEGER, text_hash TEXT)')
+        conn.executemany('INSERT INTO names (id, name, wiki_text) VALUES (?, ?, ?)',
+                         [(name_id, f'Name{name_id}', text) for name_id, text in PAGES.items()])
+    conn.close()
+
+    db = WiktionaryDB(tmp_path)
+    db.load_yaml(YAML_PATH)
+    db.update_database_structure()
+    # Exit without closing the database (and so without the commit in close)
+    db.raw_db.close()
+
+    db = WiktionaryDB(tmp_path)
+    db.load_yaml(YAML_PATH)
+    assert db.count('sqlite_master', "WHERE type='table' AND name='names_x'") == 0
+    assert 'WIKITEXT' in db.query_one("SELECT sql FROM sqlite_master WHERE name='names'")[0].upper()
+    db.update_database_structure()
+    assert get_pages(db) == PAGES
+    db.close(print_table_sizes=False)
@@ -0,0 +1,153 @@
+import shutil
+import pytest
+import yaml
+
+from buckets import file_hash
+from name_data import NamesDB
+from name_data.build import build_bulk, build_incremental, create_indexes, write_manifest
+from name_data.equivalence import build_equivalence
+from name_data.query import ConnectionPool, NameQuery
+
+DATA = {
+    'Latin_M.yaml': {
+        'Mar': {'lang': ['es'], 'is_short_for': ['María']},
+        'María': {'lang': ['es']},
+        'MAR': {'lang': ['en'], 'is_short_for': ['Marmaduke']},
+        'Marmaduke': {'lang': ['en']},
+    },
+}
+
+
+BEFORE = {
+    'Latin_A.yaml': {
+        'Abby': {'gender_flag': 1, 'lang': ['en'], 'is_short_for': ['Abigail']},
+        'Abigail': {'gender_flag': 1, 'lang': ['en'], 'origin': ['he']},
+        'Al': {'gender_flag': 2, 'is_short_for': ['Albert', 'Alfred']},
+        # Filed in the wrong buckets, and moved to Latin_B.yaml below
+        'Bert': {'lang': ['en'], 'is_short_for': ['Albert']},
+        'Rita': {'gender_flag': 1, 'lang': ['it']},
+    },
+    'Latin_B.yaml': {
+        'Bob': {'gender_flag': 2, 'lang': ['en'], 'is_short_for': ['Robert']},
+    },
+    'Latin_R.yaml': {
+        'Robert': {'gender_flag': 2, 'lang': ['en', 'de']},
+    },
+    'Latin_XYZ.yaml': {
+        'Zed': {'lang': ['en']},
+    },
+}
+AFTER = {
+    'Latin_A.yaml': {
+        # Removed Abby, changed Abigail's gender and languages, added Alice
+        'Abigail': {'gender_flag': 4, 'lang': ['en', 'fr']},
+        'Al': {'gender_flag': 2, 'is_short_for': ['Albert', 'Alfred']},
+        'Alice': {'gender_flag': 1, 'lang': ['en'], 'is_equivalent_to': ['Alicia']},
+    },
+    'Latin_B.yaml': {
+        'Bert': {'lang': ['en'], 'is_short_for': ['Albert', 'Bertram']},
+        'Bob': {'gender_flag': 2, 'lang': ['en'], 'is_short_for': ['Robert']},
+        'Rita': {'gender_flag': 1, 'lang': ['es'], 'is_short_for': ['Margarita']},
+    },
+    'Latin_R.yaml': {
+        'Robert': {'gender_flag': 2, 'lang': ['en', 'de']},
+    },
+    # Latin_XYZ.yaml was removed
+}
+
+
+def write_data(folder, data):
+    folder.mkdir(exist_ok=True)
+    for path in folder.glob('*.yaml'):
+        path.unlink()
+    for filename, bucket_data in data.items():
+        with open(folder / filename, 'w') as f:
+            yaml.safe_dump(bucket_data, f, allow_unicode=True)
+    return sorted(folder.glob('*yaml'))
+
+
+def make_db(folder):
+    folder.mkdir(exist_ok=True)
+    shutil.copy('db/names.yaml', folder / 'names.yaml')
+    db = NamesDB(folder=folder)
+    db.update_database_structure()
+    return db
+
+
+def build_full(db, data_paths):
+    build_bulk(db, data_paths, 1)
+    write_manifest(db, {path.name: file_hash(path) for path in data_paths})
+
+
+def get_rows(db):
+    """The rows of each table, with names instead of ids"""
+    names = db.dict_lookup('id', 'name', 'names')
+    rows = {
+        'gender_flag': {row['name']: row['gender_flag'] for row in db.query('SELECT * FROM names')
+                        if row['gender_flag']},
+        'relationships': sorted((names[row['name_id']], row['relationship'], names[row['name_id2']])
+                                for row in db.query('SELECT * FROM relationships')),
+        'sources': sorted(tuple(row) for row in db.query('SELECT * FROM sources')),
+    }
+    for table in ['languages', 'origins']:
+        rows[table] = sorted((names[row['name_id']], row['language']) for row in db.query(f'SELECT * FROM {table}'))
+    return rows
+
+
+@pytest.fixture
+def data_paths(tmp_path):
+    return write_data(tmp_path / 'data', DATA)
+
+
+@pytest.fixture
+def names_db(tmp_path, data_paths):
+    db = make_db(tmp_path)
+    build_full(db, data_paths)
+    yield db
+    db.close(print_table_sizes=False)
+
+
+def test_incremental_backfills_folded_names(names_db, data_paths):
+    # As in a database built before the folded_name column was added
+    names_db.execute('UPDATE names SET folded_name=NULL')
+    build_incremental(names_db, data_paths, 1)
+    folded = names_db.dict_lookup('name', 'folded_name', 'names')
+    assert folded == {name: name.casefold() for name in ['Mar', 'María', 'MAR', 'Marmaduke']}
+
+
+def test_folded_lookups_match_every_component(names_db, tmp_path):
+    build_equivalence(names_db)
+    create_indexes(names_db)
+    names_db.write()
+
+    query = NameQuery(ConnectionPool(tmp_path / 'names.db', size=1))
+    components = query.component_ids(['Mar', 'mar', 'Unknown'], folded=True)
+    assert len(components['mar']) == 2
+    assert components['Mar'] == components['mar']
+    assert components['Unknown'] == []
+    assert len(query.component_ids(['Mar'])['Mar']) == 1
+
+    assert query.are_equivalent([('mar', 'Marmaduke'), ('mar', 'maría')], folded=True) == [True, True]
+    assert query.are_equivalent([('Mar', 'Marmaduke'), ('MAR', 'Marmaduke')]) == [False, True]
+    assert query.equivalents_of(['mar'], folded=True) == {'mar': ['MAR', 'Mar', 'Marmaduke', 'María']}
+    assert query.equivalents_of(['Mar', 'Unknown']) == {'Mar': ['Mar', 'María'], 'Unknown': []}
+    assert query.equivalents_of(['unknown'], folded=True) == {'unknown': []}
+    query.pool.close()
+
+
+def test_incremental_matches_full_build(tmp_path):
+    incremental_db = make_db(tmp_path / 'incremental')
+    build_full(incremental_db, write_data(tmp_path / 'data', BEFORE))
+    before_ids = incremental_db.dict_lookup('name', 'id', 'names')
+    data_paths = write_data(tmp_path / 'data', AFTER)
+    build_incremental(incremental_db, data_paths, 1)
+
+    full_db = make_db(tmp_path / 'full')
+    build_full(full_db, data_paths)
+    assert get_rows(incremental_db) == get_rows(full_db)
+
+    # Existing names keep their ids, including the ones that are no longer used
+    after_ids = incremental_db.dict_lookup('name', 'id', 'names')
+    assert {name: after_ids[name] for name in before_ids} == before_ids
+    incremental_db.close(print_table_sizes=False)
+    full_db.close(print_table_sizes=False)
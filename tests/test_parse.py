@@ -0,0 +1,91 @@
+import pytest
+
+from wiktionary import Relationship, WikiText
+from wiktionary.parse import (NAME_QUERY, ParseWriter, load_category_names, load_stale_ids, parse_serial, parse_wiki,
+                              prescan_templates, select_pages)
+
+# Each page, and whether the prescan can handle it (rather than falling back to a full parse)
+PRESCAN_PAGES = {
+    'nested value': ('# {{given name|en|male|dim={{l|en|Joseph}}|eq=Joe}}', True),
+    'nested in another template': ('{{quote|{{given name|en|female|var=Jo}}}} {{given name|fr|female}}', True),
+    'nested inside given name': ('{{given name|en|{{gloss|male}}|eq={{given name|de|male}}}}', True),
+    'commented out': ('<!-- {{given name|fr|male}} -->\n# {{given name|en|male}}', True),
+    'comment inside': ('# {{given name|en<!-- see talk -->|male|dim=Al<!-- }} -->}}', True),
+    'unterminated comment': ('# {{given name|en|male}} <!-- {{given name|de|female}}', True),
+    'nowiki': ('<nowiki>{{given name|fr|male}}</nowiki>\n# {{given name|en|male}}', False),
+    'nowiki inside': ('# {{given name|en|male|eq=<nowiki>}}</nowiki>}}', False),
+    'parameter': ('# {{given name|en|{{{1|male}}}|dim=Bill}}', False),
+    'spans lines': ('# {{given name\n|en\n|male\n|eq=Johann}}\n# {{given name|de|\nmale\n|dim=Hans\n}}', True),
+    'sections': ('==English==\n# {{given name|en|male}}\n==German==\n# {{historical given name|de|male}}\n'
+                 '==French==\n{{alternative form of|fr|Jean}}', True),
+    'unclosed': ('# {{given name|en|male|dim=Jo', False),
+}
+
+
+def add_page(db, name_id, name, wiki_text):
+    db.bulk_insert('names', ['id', 'name', 'wiki_text'], [(name_id, name, WikiText(wiki_text))])
+
+
+def run_parse(db):
+    """Incrementally parse the pages like parse_wiki does, returning the names that were parsed"""
+    names, parse_hashes = select_pages(db.query(NAME_QUERY), load_category_names(db), True, load_stale_ids(db))
+    writer = ParseWriter(db)
+    for name_id, name, parsed_info in parse_serial(names):
+        writer.write_name(name_id, name, parsed_info, parse_hashes[name_id])
+    writer.flush()
+    return sorted(name for _, name, _, _ in names)
+
+
+def test_reparse_when_relationship_target_is_added(wiktionary_db):
+    add_page(wiktionary_db, 1, 'Jo', '# {{given name|en|male|dim=Joseph}}')
+    assert run_parse(wiktionary_db) == ['Jo']
+    assert wiktionary_db.count('relationships') == 0
+    assert run_parse(wiktionary_db) == []
+
+    add_page(wiktionary_db, 2, 'Joseph', '# {{given name|en|male}}')
+    assert run_parse(wiktionary_db) == ['Jo', 'Joseph']
+    assert [tuple(row) for row in wiktionary_db.query('SELECT * FROM relationships')] == [
+        (1, Relationship.IS_SHORT_FOR, 2)]
+    assert wiktionary_db.count('unresolved_targets') == 0
+    assert run_parse(wiktionary_db) == []
+
+
+def test_rows_kept_for_pages_without_new_results(wiktionary_db):
+    add_page(wiktionary_db, 1, 'Jo', '# {{given name|en|male}}')
+    run_parse(wiktionary_db)
+    assert wiktionary_db.count('name_lang') == 1
+
+    # A page that fails to parse is never passed to write_name, so its old results stay
+    writer = ParseWriter(wiktionary_db)
+    writer.flush()
+    assert wiktionary_db.count('name_lang') == 1
+
+    writer.write_name(1, 'Jo', {'given-name.lang': {'fr'}})
+    writer.flush()
+    assert [tuple(row) for row in wiktionary_db.query('SELECT * FROM name_lang')] == [(1, 'fr')]
+
+
+def test_failed_write_keeps_previous_results(wiktionary_db):
+    add_page(wiktionary_db, 1, 'Jo', '# {{given name|en|male}}')
+    run_parse(wiktionary_db)
+    wiktionary_db.execute('UPDATE names SET wiki_text=? WHERE id=1', (WikiText('# {{given name|fr|male}}'),))
+
+    writer = ParseWriter(wiktionary_db)
+    names, parse_hashes = select_pages(wiktionary_db.query(NAME_QUERY), load_category_names(wiktionary_db))
+    assert [name for _, name, _, _ in names] == ['Jo']
+    for parsed_info in [{'given-name.lang': {'fr'}, 'given-name.gender': {'neuter'}},
+                        {'given-name.lang': {'fr'}, 'given-name.unknown': {'x'}}]:
+        with pytest.raises((KeyError, RuntimeError)):
+            writer.write_name(1, 'Jo', parsed_info, parse_hashes[1])
+    writer.flush()
+
+    # The page keeps its old rows, and is not marked as parsed, so the next incremental run retries it
+    assert [tuple(row) for row in wiktionary_db.query('SELECT * FROM name_lang')] == [(1, 'en')]
+    assert run_parse(wiktionary_db) == ['Jo']
+    assert [tuple(row) for row in wiktionary_db.query('SELECT * FROM name_lang')] == [(1, 'fr')]
+
+
+@pytest.mark.parametrize('wiki_text, scannable', PRESCAN_PAGES.values(), ids=PRESCAN_PAGES.keys())
+def test_prescan_matches_full_parse(wiki_text, scannable):
+    assert (prescan_templates(wiki_text) is not None) == scannable
+    assert parse_wiki('Test', wiki_text, prescan=True) == parse_wiki('Test', wiki_text, prescan=False)
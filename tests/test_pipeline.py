@@ -0,0 +1,36 @@
+import argparse
+import functools
+import threading
+
+import pytest
+
+from wiktionary import WikiText, pipeline
+from wiktionary.api import WikiAPI
+
+
+def test_original_error_is_raised_when_dump_also_fails(wiktionary_db, tmp_path, monkeypatch):
+    wiktionary_db.bulk_insert('names', ['id', 'name', 'wiki_text'],
+                              [(1, 'Abe', WikiText('# {{given name|en|male}}')),
+                               (2, 'Bob', WikiText('# {{given name|en|male}}'))])
+    dump_failed = threading.Event()
+
+    def update_bucket(*args):
+        dump_failed.set()
+        raise OSError('disk full')
+
+    def parse_bucket(db, writer, category_names, name_ids):
+        if name_ids == [2]:
+            # Only fail once the dump stage has failed on the first bucket
+            dump_failed.wait(5)
+            raise ValueError('parse failed')
+        return 0
+
+    monkeypatch.setattr(pipeline, 'update_bucket', update_bucket)
+    monkeypatch.setattr(pipeline, 'parse_bucket', parse_bucket)
+    checkpoint_path = tmp_path / 'checkpoint.json'
+    monkeypatch.setattr(pipeline, 'Checkpoint', functools.partial(pipeline.Checkpoint, checkpoint_path))
+
+    args = argparse.Namespace(restart=True, recrawl_pages=False, queue_size=4, batch_size=50, trim_sections=False)
+    with pytest.raises(ValueError, match='parse failed'):
+        pipeline.run_pipeline(wiktionary_db, WikiAPI('http://127.0.0.1:9/'), args)
+    assert not checkpoint_path.exists()
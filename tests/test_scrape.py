@@ -0,0 +1,112 @@
+import json
+import urllib.parse
+
+import pytest
+
+from wiktionary.api import WikiAPI
+from wiktionary.scrape import crawl_name_page, crawl_name_pages, fill_touched
+
+PAGES = {f'Name{i:03d}': (1000 + i, f'{{{{given name|en|male}}}} {i}') for i in range(120)}
+
+
+def revisions_response(params):
+    pages = []
+    for title in params['titles'].split('|'):
+        if title in PAGES:
+            revid, text = PAGES[title]
+            pages.append({'title': title, 'revisions': [{'revid': revid, 'slots': {'main': {'content': text}}}]})
+        else:
+            pages.append({'title': title, 'missing': True})
+    return 200, {'Content-Type': 'application/json'}, json.dumps({'query': {'pages': pages}})
+
+
+def get_params(path):
+    return dict(urllib.parse.parse_qsl(urllib.parse.urlparse(path).query))
+
+
+def request_titles(server):
+    return [tuple(get_params(path)['titles'].split('|')) for path, _ in server.requests]
+
+
+def add_names(db, titles):
+    db.bulk_insert('names', ['id', 'name'], list(enumerate(titles, 1)))
+    return [dict(row) for row in db.query('SELECT id, name, revid, text_hash FROM names')]
+
+
+def test_crawl_batches_and_retries(stub_server, wiktionary_db):
+    failed = set()
+
+    def respond(handler):
+        # The first request for each batch fails with a retryable error
+        params = get_params(handler.path)
+        if params['titles'] not in failed:
+            failed.add(params['titles'])
+            return 503, {}, ''
+        return revisions_response(params)
+
+    server = stub_server(respond)
+    api = WikiAPI(server.url, jobs=4, rate=None, backoff=0.01)
+    names = add_names(wiktionary_db, list(PAGES) + ['Missing'])
+    crawl_name_pages(wiktionary_db, api, names, batch_size=50)
+
+    batches = request_titles(server)
+    assert all(len(titles) <= 50 for titles in batches)
+    # Each of the three batches is requested twice: the failure, then the retry
+    assert len(batches) == 6
+    assert all(batches.count(titles) == 2 for titles in batches)
+    assert sorted(title for titles in set(batches) for title in titles) == sorted(name_d['name'] for name_d in names)
+
+    rows = {row['name']: row for row in wiktionary_db.query('SELECT name, revid, wiki_text, last_crawl FROM names')}
+    for title, (revid, text) in PAGES.items():
+        assert rows[title]['revid'] == revid
+        assert rows[title]['wiki_text'] == text
+        assert rows[title]['last_crawl'] is not None
+    assert rows['Missing']['wiki_text'] is None
+
+
+def test_retries_give_up(stub_server):
+    server = stub_server(lambda handler: (503, {}, ''))
+    api = WikiAPI(server.url, jobs=1, rate=None, retries=2, backoff=0.01)
+    with pytest.raises(RuntimeError, match='Gave up after 2 retries'):
+        api.page_revisions(['Name000'])
+    assert len(server.requests) == 3
+
+
+def test_retry_after_and_user_agent(stub_server):
+    attempts = []
+
+    def respond(handler):
+        attempts.append(handler.headers['User-Agent'])
+        if len(attempts) == 1:
+            return 429, {'Retry-After': '0'}, ''
+        return revisions_response(get_params(handler.path))
+
+    server = stub_server(respond)
+    api = WikiAPI(server.url, jobs=1, rate=None, backoff=0.01)
+    assert api.page_revisions(['Name001']) == {'Name001': PAGES['Name001']}
+    assert len(attempts) == 2
+    assert all(agent.startswith('namor_data') for agent in attempts)
+
+
+def test_serial_crawl_stores_revid(stub_server, wiktionary_db):
+    server = stub_server(lambda handler: revisions_response(get_params(handler.path)))
+    api = WikiAPI(server.url, jobs=1, rate=None)
+    name_d, = add_names(wiktionary_db, ['Name007'])
+    crawl_name_page(wiktionary_db, api, name_d)
+    row = wiktionary_db.query_one('SELECT revid, wiki_text FROM names')
+    assert (row['revid'], row['wiki_text']) == PAGES['Name007']
+
+
+def test_fill_touched(stub_server):
+    def respond(handler):
+        titles = get_params(handler.path)['titles'].split('|')
+        pages = [{'title': title, 'touched': '2024-01-01T00:00:00Z'} for title in titles]
+        return 200, {}, json.dumps({'query': {'pages': pages}})
+
+    server = stub_server(respond)
+    api = WikiAPI(server.url, jobs=1, rate=None)
+    categories = [{'name': 'Category:English given names', 'touched': None},
+                  {'name': 'Category:Checked', 'touched': '2020-01-01T00:00:00Z'}]
+    fill_touched(api, categories)
+    assert [category_d['touched'] for category_d in categories] == ['2024-01-01T00:00:00Z', '2020-01-01T00:00:00Z']
+    assert request_titles(server) == [('Category:English given names',)]
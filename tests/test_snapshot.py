@@ -0,0 +1,86 @@
+import shutil
+
+import pytest
+
+from name_data import NamesDB
+from name_data.snapshot import Snapshot, write_snapshot
+from wiktionary import Relationship
+
+NAMES = {1: ('Zoe', 1), 2: ('Émile', 2), 3: ('Al', 2), 4: ('Albert', 2), 5: ('Alfred', None), 6: ('Zoë', 1),
+         7: ('Ōta', None), 8: ('Bob', 2), 9: ('Robert', 2)}
+LANGUAGES = [(1, 'en'), (1, 'el'), (2, 'fr'), (3, 'en'), (4, 'en'), (4, 'de'), (4, 'fr'), (6, 'en'), (7, 'ja'),
+             (8, 'en'), (9, 'en')]
+ORIGINS = [(1, 'grc'), (4, 'gem'), (9, 'gem'), (9, 'ang')]
+RELATIONSHIPS = [(3, Relationship.IS_SHORT_FOR, 4), (3, Relationship.IS_SHORT_FOR, 5),
+                 (3, Relationship.IS_SHORT_FOR, 5), (8, Relationship.IS_SHORT_FOR, 9),
+                 (6, Relationship.IS_A_VARIANT_OF, 1), (6, Relationship.IS_EQUIVALENT_TO, 1)]
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    shutil.copy('db/names.yaml', tmp_path / 'names.yaml')
+    db = NamesDB(folder=tmp_path)
+    db.update_database_structure()
+    db.bulk_insert('names', ['id', 'name', 'gender_flag'],
+                   [(name_id, name, gender_flag) for name_id, (name, gender_flag) in NAMES.items()])
+    db.bulk_insert('languages', ['name_id', 'language'], LANGUAGES)
+    db.bulk_insert('origins', ['name_id', 'language'], ORIGINS)
+    db.bulk_insert('relationships', ['name_id', 'relationship', 'name_id2'], RELATIONSHIPS)
+    size = write_snapshot(db, tmp_path / 'names.snapshot')
+    db.close(print_table_sizes=False)
+    assert (tmp_path / 'names.snapshot').stat().st_size == size
+
+    snapshot = Snapshot(tmp_path / 'names.snapshot')
+    yield snapshot
+    snapshot.close()
+
+
+def get_expected(name_id):
+    """The entry for the name, built from the table rows"""
+    name, gender_flag = NAMES[name_id]
+    entry = {}
+    if gender_flag:
+        entry['gender_flag'] = gender_flag
+    for key, rows in [('lang', LANGUAGES), ('origin', ORIGINS)]:
+        values = sorted(language for row_id, language in rows if row_id == name_id)
+        if values:
+            entry[key] = values
+    for rel in Relationship:
+        others = {NAMES[other_id][0] for row_id, row_rel, other_id in RELATIONSHIPS
+                  if row_id == name_id and row_rel == rel}
+        if others:
+            entry[rel.name.lower()] = sorted(others, key=str.encode)
+    return entry
+
+
+def test_lookup_matches_tables(snapshot):
+    assert len(snapshot) == len(NAMES)
+    for name_id, (name, _) in NAMES.items():
+        assert snapshot.lookup(name) == get_expected(name_id), name
+
+
+def test_sections_match_tables(snapshot):
+    names = sorted((name for name, _ in NAMES.values()), key=str.encode)
+    assert [snapshot.name(i) for i in range(len(snapshot))] == names
+
+    languages = sorted({language for _, language in LANGUAGES + ORIGINS})
+    assert [snapshot.lang(j) for j in range(len(snapshot.lang_off) - 1)] == languages
+
+    for name_id, (name, _) in NAMES.items():
+        i = snapshot.find(name)
+        assert snapshot.name(i) == name
+        # lang_idx holds indexes into the interned languages, sorted within each name
+        lang_idx = list(snapshot.lang_idx[snapshot.lang_ptr[i]:snapshot.lang_ptr[i + 1]])
+        assert lang_idx == sorted(languages.index(language) for row_id, language in LANGUAGES if row_id == name_id)
+        assert snapshot.origins(i) == sorted(language for row_id, language in ORIGINS if row_id == name_id)
+        # The CSR neighbours, with duplicate rows removed
+        assert sorted(snapshot.relationships(i)) == sorted({(rel, NAMES[other_id][0])
+                                                            for row_id, rel, other_id in RELATIONSHIPS
+                                                            if row_id == name_id})
+    assert snapshot.rel_ptr[-1] == len(set(RELATIONSHIPS))
+
+
+@pytest.mark.parametrize('name', ['', 'A', 'Alberta', 'Zo', 'Zoé', '\U0010ffff', 'zoe'])
+def test_missing_names(snapshot, name):
+    assert snapshot.find(name) is None
+    assert snapshot.lookup(name) is None
@@ -0,0 +1,191 @@
+import sys
+
+import pytest
+import yaml
+
+from misc_sources import update
+from misc_sources.update import fetch, make_session
+
+ETAG = '"v1"'
+LAST_MODIFIED = 'Wed, 21 Oct 2015 07:28:00 GMT'
+BODY = 'Abraham\tAbe\n'
+
+
+def test_fetch_etag(stub_server, tmp_path):
+    def respond(handler):
+        if handler.headers.get('If-None-Match') == ETAG:
+            return 304, {'ETag': ETAG}, ''
+        return 200, {'ETag': ETAG, 'Last-Modified': LAST_MODIFIED}, BODY
+
+    server = stub_server(respond)
+    session = make_session(1, retries=0)
+    path = tmp_path / 'nicknames.txt'
+
+    changed, validators = fetch(session, server.url + 'nicknames.txt', path, {}, 5)
+    assert changed
+    assert validators == {'etag': ETAG, 'last_modified': LAST_MODIFIED}
+    assert path.read_text() == BODY
+    assert 'If-None-Match' not in server.requests[0][1]
+
+    changed, new_validators = fetch(session, server.url + 'nicknames.txt', path, validators, 5)
+    assert not changed
+    assert new_validators == validators
+    headers = server.requests[1][1]
+    assert headers['If-None-Match'] == ETAG
+    assert headers['If-Modified-Since'] == LAST_MODIFIED
+    assert path.read_text() == BODY
+
+    # The validators are only sent when the file is still in the cache
+    path.unlink()
+    changed, _ = fetch(session, server.url + 'nicknames.txt', path, validators, 5)
+    assert changed
+    assert 'If-None-Match' not in server.requests[2][1]
+
+
+def test_fetch_if_modified_since(stub_server, tmp_path):
+    body = {'text': BODY}
+
+    def respond(handler):
+        if handler.headers.get('If-Modified-Since') == LAST_MODIFIED and body['text'] == BODY:
+            return 304, {}, ''
+        return 200, {'Last-Modified': LAST_MODIFIED}, body['text']
+
+    server = stub_server(respond)
+    session = make_session(1, retries=0)
+    path = tmp_path / 'nicknames.txt'
+    path.write_text(BODY)
+
+    changed, validators = fetch(session, server.url, path, {'last_modified': LAST_MODIFIED}, 5)
+    assert not changed
+    assert validators == {'last_modified': LAST_MODIFIED}
+    assert 'If-None-Match' not in server.requests[0][1]
+
+    # A full response with the same content does not count as a change, but still updates the validators
+    changed, validators = fetch(session, server.url, path, {'last_modified': 'Tue, 20 Oct 2015 07:28:00 GMT'}, 5)
+    assert not changed
+    assert validators == {'etag': None, 'last_modified': LAST_MODIFIED}
+
+    body['text'] = 'Abraham\tAbe\tBram\n'
+    changed, _ = fetch(session, server.url, path, validators, 5)
+    assert changed
+    assert path.read_text() == body['text']
+    assert not path.with_name('nicknames.txt.tmp').exists()
+
+
+@pytest.fixture
+def sources(stub_server, tmp_path, monkeypatch):
+    """Point update_misc_sources at a stub server serving a brianary file, with the cache and data in tmp_path"""
+    content = {'body': BODY}
+
+    def respond(handler):
+        return 200, {'ETag': f'"{len(content["body"])}"'}, content['body']
+
+    server = stub_server(respond)
+    monkeypatch.setattr(update, 'SOURCES', {'brianary': server.url + 'nicknames.txt'})
+    monkeypatch.setattr(update, 'CACHE_FOLDER', tmp_path / 'cache')
+    monkeypatch.setattr(update, 'INTEGRATED_PATH', tmp_path / 'cache' / 'integrated.yaml')
+    monkeypatch.setattr(update, 'ROOT', tmp_path / 'data')
+    (tmp_path / 'data').mkdir()
+    server.content = content
+    return server
+
+
+def run_update(tmp_path, monkeypatch, *args):
+    monkeypatch.setattr(sys, 'argv', ['update_misc_sources', '-j', '1', '--metrics', str(tmp_path / 'metrics.json'),
+                                      *args])
+    update.main()
+
+
+def load_data(tmp_path):
+    return {path.name: yaml.safe_load(path.read_text()) for path in sorted((tmp_path / 'data').glob('*.yaml'))}
+
+
+def test_update_reintegrates_regenerated_data(sources, tmp_path, monkeypatch, capsys):
+    run_update(tmp_path, monkeypatch)
+    validators_path = tmp_path / 'cache' / 'brianary' / update.VALIDATORS_FILENAME
+    assert yaml.safe_load(validators_path.read_text())['nicknames.txt']['etag'] == '"12"'
+    assert load_data(tmp_path) == {'Latin_A.yaml': {'Abe': {'is_short_for': ['Abraham']}}}
+
+    # Touching the raw file does not change its contents, so nothing is parsed or integrated
+    raw_path = tmp_path / 'cache' / 'brianary' / 'nicknames.txt'
+    raw_path.write_text(BODY)
+    capsys.readouterr()
+    run_update(tmp_path, monkeypatch)
+    assert 'No sources or bucket files have changed' in capsys.readouterr().out
+
+    # A regenerated bucket file is integrated again, even though none of the sources changed
+    (tmp_path / 'data' / 'Latin_A.yaml').write_text(yaml.safe_dump({'Abel': {'lang': ['en']}}))
+    run_update(tmp_path, monkeypatch)
+    assert load_data(tmp_path) == {'Latin_A.yaml': {'Abe': {'is_short_for': ['Abraham']}, 'Abel': {'lang': ['en']}}}
+
+
+def test_update_keeps_validators_when_integrate_fails(sources, tmp_path, monkeypatch):
+    run_update(tmp_path, monkeypatch)
+    validators_path = tmp_path / 'cache' / 'brianary' / update.VALIDATORS_FILENAME
+    validators = validators_path.read_text()
+
+    def fail(common):
+        raise RuntimeError('integrate failed')
+
+    sources.content['body'] = 'Abraham\tAbe Bram\n'
+    with monkeypatch.context() as m:
+        m.setattr(update, 'integrate', fail)
+        with pytest.raises(RuntimeError):
+            run_update(tmp_path, monkeypatch, '-d')
+    assert validators_path.read_text() == validators
+
+    # The new raw file was already parsed, but it has not been integrated yet
+    run_update(tmp_path, monkeypatch, '-d')
+    assert load_data(tmp_path) == {'Latin_A.yaml': {'Abe': {'is_short_for': ['Abraham']}},
+                                   'Latin_B.yaml': {'Bram': {'is_short_for': ['Abraham']}}}
+    assert validators_path.read_text() != validators
+
+
+def test_integrate_merges_sources(tmp_path, monkeypatch):
+    monkeypatch.setattr(update, 'ROOT', tmp_path)
+    (tmp_path / 'Latin_A.yaml').write_text(yaml.safe_dump({
+        'Abe': {'lang': ['en']},
+        'Al': {'gender_flag': 2, 'is_short_for': ['Alan']},
+    }))
+    # The earlier sources take precedence, so they are passed in order
+    common = {
+        'first': {
+            'Bea': {'gender_flag': 1, 'is_short_for': ['Beatrice']},
+            'Abe': {'gender_flag': 2, 'is_short_for': ['Abraham']},
+            'Zoë': {'gender_flag': 1},
+        },
+        'second': {
+            'Al': {'gender_flag': 1, 'is_short_for': ['Albert']},
+            'Abe': {'gender_flag': 1, 'is_short_for': ['Abel']},
+            'Adam': {'gender_flag': 2},
+        },
+    }
+
+    calls = []
+    real_update_bucket = update.update_bucket
+
+    def update_bucket(bucket, root, updates, apply_fn):
+        calls.append((bucket, [(name, [sorted(entry.get('is_short_for', [])) for entry in entries])
+                               for name, entries in updates]))
+        real_update_bucket(bucket, root, updates, apply_fn)
+
+    monkeypatch.setattr(update, 'update_bucket', update_bucket)
+    update.integrate(common)
+
+    # Each bucket is written once, with its names in order, and each name's entries in source order
+    assert calls == [
+        (('Latin', 'A'), [('Abe', [['Abraham'], ['Abel']]), ('Adam', [[]]), ('Al', [['Albert']])]),
+        (('Latin', 'B'), [('Bea', [['Beatrice']])]),
+        (('Latin', 'XYZ'), [('Zoë', [[]])]),
+    ]
+    # The gender flags are OR'ed together, and for the other fields the existing data wins, then the first source
+    data = {path.name: yaml.safe_load(path.read_text()) for path in sorted(tmp_path.glob('*.yaml'))}
+    assert data == {
+        'Latin_A.yaml': {
+            'Abe': {'gender_flag': 3, 'is_short_for': ['Abraham'], 'lang': ['en']},
+            'Adam': {'gender_flag': 2},
+            'Al': {'gender_flag': 3, 'is_short_for': ['Alan']},
+        },
+        'Latin_B.yaml': {'Bea': {'gender_flag': 1, 'is_short_for': ['Beatrice']}},
+        'Latin_XYZ.yaml': {'Zoë': {'gender_flag': 1}},
+    }
@@ -1,5 +1,6 @@
 from metro_db import MetroDB
 import pathlib
+import zlib
 from enum import IntEnum, IntFlag, auto
 
 
@@ -26,6 +27,29 @@ class GenderFlag(IntFlag):
     UNISEX = auto()
 
 
+class WikiText(str):
+    """Page text that is stored zlib-compressed. Columns with the wikitext type are decompressed when read"""
+
+
+def compress_text(text):
+    return zlib.compress(text.encode())
+
+
+def decompress_text(data):
+    try:
+        return zlib.decompress(data).decode()
+    except zlib.error:
+        # Stored before compression was added
+        return data.decode()
+
+
 class WiktionaryDB(MetroDB):
-    def __init__(self):
-        MetroDB.__init__(self, 'wiktionary', folder=pathlib.Path(__file__).parent, enums_to_register=[Relationship])
+    def __init__(self, folder=pathlib.Path(__file__).parent):
+        MetroDB.__init__(self, 'wiktionary', folder=folder, enums_to_register=[Relationship])
+        self.register_custom_type('wikitext', WikiText, compress_text, decompress_text)
+
+    def update_database_structure(self):
+        MetroDB.update_database_structure(self)
+        # Changing a column's type renames the table to <table>_x and copies the rows into a new table. The copy is
+        # only committed by the next write, so it is committed here, in case the process exits before then
+        self.write()
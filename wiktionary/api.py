@@ -0,0 +1,123 @@
+import concurrent.futures
+import threading
+import time
+import requests
+
+API_ENDPOINT = 'https://en.wiktionary.org/w/api.php'
+USER_AGENT = 'namor_data (https://github.com/DLu/namor_data)'
+
+# Maximum number of titles the API will return content for in a single request
+MAX_TITLES = 50
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class RateLimiter:
+    """Spaces out calls to wait() so that at most `rate` happen per second, across all threads"""
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class WikiAPI:
+    """Minimal MediaWiki API client for fetching many pages concurrently"""
+
+    def __init__(self, endpoint=API_ENDPOINT, jobs=4, rate=10.0, retries=5, backoff=1.0, timeout=60):
+        self.endpoint = endpoint
+        self.jobs = jobs
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.limiter = RateLimiter(rate)
+
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(jobs, 1))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, params):
+        params = dict(params, action='query', format='json', formatversion=2)
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+            delay = self.backoff * 2 ** attempt
+            try:
+                response = self.session.get(self.endpoint, params=params, timeout=self.timeout)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    data = response.json()
+                    if data.get('error', {}).get('code') != 'maxlag':
+                        if 'error' in data:
+                            raise RuntimeError(f'API error: {data["error"]}')
+                        return data
+                retry_after = response.headers.get('Retry-After')
+                if retry_after and retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+            time.sleep(delay)
+        raise RuntimeError(f'Gave up after {self.retries} retries: {params.get("titles", params)}')
+
+    def query(self, params):
+        """Run a query, following continuations, and return the combined list of pages"""
+        pages = {}
+        params = dict(params)
+        while True:
+            data = self.get(params)
+            normalized = {d['to']: d['from'] for d in data.get('query', {}).get('normalized', [])}
+            for page in data.get('query', {}).get('pages', []):
+                title = normalized.get(page['title'], page['title'])
+                if title in pages:
+                    pages[title].update(page)
+                else:
+                    pages[title] = page
+            if 'continue' not in data:
+                return pages
+            params.update(data['continue'])
+
+    def page_info(self, titles):
+        """Fetch the basic info (lastrevid, touched, etc) for a batch of titles"""
+        pages = self.query({'prop': 'info', 'titles': '|'.join(titles)})
+        return {title: pages.get(title, {}) for title in titles}
+
+    def page_revisions(self, titles):
+        """Fetch the current revision id and wikitext for a batch of titles. Missing pages map to (None, None)"""
+        pages = self.query({'prop': 'revisions', 'rvprop': 'ids|content', 'rvslots': 'main',
+                            'titles': '|'.join(titles)})
+        revisions = {}
+        for title in titles:
+            page = pages.get(title, {})
+            if page.get('revisions'):
+                revision = page['revisions'][0]
+                revisions[title] = revision['revid'], revision['slots']['main']['content']
+            else:
+                revisions[title] = None, None
+        return revisions
+
+    def map_batches(self, fn, titles, batch_size=MAX_TITLES):
+        """Call fn on batches of the titles, with up to `jobs` requests in flight at once.
+
+        Yields the result for each batch, in the order the batches complete"""
+        batches = list(chunks(list(titles), min(batch_size, MAX_TITLES)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [executor.submit(fn, batch) for batch in batches]
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
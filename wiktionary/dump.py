@@ -1,14 +1,15 @@
 from . import WiktionaryDB
-from buckets import get_bucket
-import click
+from buckets import get_bucket, get_buckets, update_bucket
+from instrumentation import add_arguments, count, hot_loop, instrument, timer
+import argparse
+import collections
+import itertools
+import json
 import pathlib
-import yaml
 
 ROOT = pathlib.Path('data/')
 ROOT.mkdir(exist_ok=True)
 
-seen = set()
-
 
 def to_yaml_dict(d):
     new_d = {}
@@ -22,61 +23,116 @@ def to_yaml_dict(d):
     return new_d
 
 
+# By bucket and then by name, so that each bucket's names come out together in a single pass.
+# bucket_key is registered on the connection by merge_streams
+NAME_ORDER = 'ORDER BY bucket_key(names.name), names.name COLLATE NOCASE ASC, names.id ASC'
+# Optionally restricts each query to the names whose ids are in a json list
+ID_FILTER = ' AND names.id IN (SELECT value FROM json_each(?))'
+NAMES_QUERY = ('SELECT names.id AS name_id, name, gender_flag, bucket_key(name) AS bucket FROM names'
+               ' LEFT JOIN name_info ON names.id == name_info.id'
+               ' WHERE wiki_text IS NOT NULL{filter} ' + NAME_ORDER)
+# Each of these is ordered the same way as NAMES_QUERY so they can be merged with it in a single pass
+FIELD_QUERIES = {
+    'relationships': ('SELECT relationships.name_id, relationship, others.name AS other_name FROM relationships'
+                      ' JOIN names ON relationships.name_id == names.id'
+                      ' JOIN names AS others ON relationships.name_id2 == others.id'
+                      ' WHERE names.wiki_text IS NOT NULL{filter} ' + NAME_ORDER),
+    'lang': ('SELECT name_id, lang FROM name_lang JOIN names ON name_id == names.id'
+             ' WHERE wiki_text IS NOT NULL{filter} ' + NAME_ORDER),
+    'origin': ('SELECT name_id, lang FROM name_origin JOIN names ON name_id == names.id'
+               ' WHERE wiki_text IS NOT NULL{filter} ' + NAME_ORDER),
+}
+
+
+def bucket_key(name):
+    return '_'.join(get_bucket(name))
+
+
+def run_query(db, query, name_ids=None):
+    if name_ids is None:
+        return db.execute(query.format(filter=''))
+    return db.execute(query.format(filter=ID_FILTER), (json.dumps(sorted(name_ids)),))
+
+
+def merge_streams(db, name_ids=None):
+    """Yield each row from NAMES_QUERY along with the matching rows from each of the FIELD_QUERIES.
+
+    The rows are ordered by bucket (name_d['bucket']), then by name. If name_ids is given, only those names are
+    included"""
+    db.raw_db.create_function('bucket_key', 1, bucket_key, deterministic=True)
+    groups = {}
+    current = {}
+    for key, query in FIELD_QUERIES.items():
+        groups[key] = itertools.groupby(run_query(db, query, name_ids), key=lambda row: row['name_id'])
+        current[key] = next(groups[key], None)
+
+    for name_d in run_query(db, NAMES_QUERY, name_ids):
+        name_id = name_d['name_id']
+        field_rows = {}
+        for key in FIELD_QUERIES:
+            if current[key] and current[key][0] == name_id:
+                field_rows[key] = list(current[key][1])
+                current[key] = next(groups[key], None)
+            else:
+                field_rows[key] = []
+        yield name_d, field_rows
+
+
+def get_update(name_d, field_rows):
+    """The update for update_entry from one of the results of merge_streams"""
+    return {
+        'gender_flag': name_d['gender_flag'],
+        'relationships': [(rel['relationship'].name.lower(), rel['other_name']) for rel in field_rows['relationships']],
+        'lang': [row['lang'] for row in field_rows['lang']],
+        'origin': [row['lang'] for row in field_rows['origin']],
+    }
+
+
+def update_entry(data, name, update):
+    if name not in data:
+        data[name] = {}
+
+    entry = data[name]
+
+    # Convert lists to set
+    for field in entry:
+        if isinstance(entry[field], list):
+            entry[field] = set(entry[field])
+
+    if update['gender_flag']:
+        entry['gender_flag'] = entry.get('gender_flag', 0) | update['gender_flag']
+
+    for key, other_name in update['relationships']:
+        if key not in entry:
+            entry[key] = set()
+        entry[key].add(other_name)
+    for field in ['lang', 'origin']:
+        for lang in update[field]:
+            if field not in entry:
+                entry[field] = set()
+            entry[field].add(lang)
+
+
+def group_by_bucket(names):
+    """Group the name dictionaries by the bucket of their name, in order of bucket"""
+    buckets = collections.defaultdict(list)
+    for name_d, bucket in zip(names, get_buckets([name_d['name'] for name_d in names])):
+        buckets[bucket].append(name_d)
+    return sorted(buckets.items())
+
+
 def main():
-    db = WiktionaryDB()
-    db.update_database_structure()
-    current_bucket = None
-    current_path = None
-    current_data = None
-
-    name_lookup = db.dict_lookup('id', 'name', 'names')
-
-    try:
-        for name_d in db.query('SELECT * FROM names LEFT JOIN name_info ON names.id == name_info.id'
-                               ' WHERE wiki_text IS NOT NULL ORDER BY name COLLATE NOCASE ASC'):
-            name = name_d['name']
-            name_id = name_d['id']
-            bucket = get_bucket(name)
-
-            if bucket != current_bucket:
-                if current_data is not None:
-                    yaml.safe_dump(to_yaml_dict(current_data), open(current_path, 'w'), allow_unicode=True)
-                current_bucket = bucket
-                bucket_s = ' '.join(bucket)
-                click.secho('Switching to ', nl=False)
-                click.secho(f'{bucket_s:20}', nl=False, fg='bright_blue')
-                click.secho(f' ({name})')
-                current_path = ROOT / ('_'.join(bucket) + '.yaml')
-                if current_path.exists():
-                    current_data = yaml.safe_load(open(current_path))
-                else:
-                    current_data = {}
-
-            if name not in current_data:
-                current_data[name] = {}
-
-            entry = current_data[name]
-
-            # Convert lists to set
-            for field in entry:
-                if isinstance(entry[field], list):
-                    entry[field] = set(entry[field])
-
-            name_d = dict(name_d)
-
-            if name_d.get('gender_flag'):
-                entry['gender_flag'] = entry.get('gender_flag', 0) | name_d['gender_flag']
-
-            for rel in db.query(f'SELECT relationship, name_id2 FROM relationships WHERE name_id={name_id}'):
-                key = rel['relationship'].name.lower()
-                if key not in entry:
-                    entry[key] = set()
-                entry[key].add(name_lookup[rel['name_id2']])
-            for field in ['lang', 'origin']:
-                for lang in db.lookup_all('lang', f'name_{field}', {'name_id': name_id}):
-                    if field not in entry:
-                        entry[field] = set()
-                    entry[field].add(lang)
-    finally:
-        if current_data is not None:
-            yaml.safe_dump(to_yaml_dict(current_data), open(current_path, 'w'), allow_unicode=True)
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrument('dump_wiki', args), WiktionaryDB() as db:
+        # Each table is read once, and only one bucket's worth of updates is in memory at a time
+        streams = itertools.groupby(merge_streams(db), key=lambda item: item[0]['bucket'])
+        for _, bucket_rows in streams:
+            with timer('stage.merge'), hot_loop():
+                updates = [(name_d['name'], get_update(name_d, field_rows)) for name_d, field_rows in bucket_rows]
+            bucket = get_bucket(updates[0][0])
+            count('pages', len(updates))
+            with timer('stage.write'):
+                update_bucket(bucket, ROOT, updates, update_entry, to_yaml_dict)
@@ -0,0 +1,234 @@
+import argparse
+import bz2
+import click
+import collections
+import datetime
+import pathlib
+import re
+import xml.etree.ElementTree as ET
+from tqdm import tqdm
+
+from instrumentation import add_arguments, count, hot_loop, instrument, timer
+from . import WiktionaryDB
+from .parse import LANG_GIVEN_NAMES, TRAILING_NUMBER, language_cache
+from .scrape import CAT_PREFIX, pack_text, text_hash
+
+GIVEN_NAME_TEMPLATE = re.compile(r'\{\{\s*(historical )?given name\s*\|')
+CATEGORY_LINK = re.compile(r'\[\[\s*Category\s*:\s*([^\]|]+)')
+# The parameters of a {{given name}} template, which adds the page to the matching given name categories
+GIVEN_NAME_PARAMS = re.compile(r'\{\{\s*given name\s*\|([^{}]*)\}\}')
+GENDERS = ['male', 'female', 'unisex']
+MAIN_NAMESPACE = '0'
+CATEGORY_NAMESPACE = '14'
+
+
+def get_template_categories(text):
+    """Return the (language, gender, origins) of each {{given name}} template in the text.
+
+    The language is a code, the gender is empty if it isn't given, and origins are as written in the template"""
+    templates = []
+    for m in GIVEN_NAME_PARAMS.finditer(text):
+        positional = []
+        origins = []
+        for param in m.group(1).split('|'):
+            key, eq, value = param.partition('=')
+            if not eq:
+                positional.append(param.strip())
+            elif TRAILING_NUMBER.sub(r'\1', key.strip()) == 'from':
+                origins.append(value.strip())
+        if not positional or not positional[0]:
+            continue
+        gender = positional[1] if len(positional) > 1 and positional[1] in GENDERS else ''
+        origins += positional[2:5]
+        templates.append((positional[0], gender, [origin for origin in origins if origin]))
+    return templates
+
+
+def local_name(tag):
+    return tag.rpartition('}')[2]
+
+
+def normalize_title(title):
+    return title.replace('_', ' ').strip()
+
+
+def iter_pages(path):
+    """Stream the pages out of a (possibly bz2-compressed) MediaWiki XML export.
+
+    Each page is cleared from the tree once it has been yielded, so memory stays bounded."""
+    opener = bz2.open if path.suffix == '.bz2' else open
+    with opener(path, 'rb') as f:
+        context = ET.iterparse(f, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event != 'end' or local_name(elem.tag) != 'page':
+                continue
+            page = {}
+            for child in elem:
+                tag = local_name(child.tag)
+                if tag in ['title', 'ns']:
+                    page[tag] = child.text
+                elif tag == 'revision':
+                    for rev_child in child:
+                        rev_tag = local_name(rev_child.tag)
+                        if rev_tag == 'id':
+                            page['revid'] = int(rev_child.text)
+                        elif rev_tag == 'text':
+                            page['text'] = rev_child.text or ''
+            yield page
+            root.clear()
+
+
+class DumpIngester:
+    def __init__(self, db, batch_size=1000, trim=False):
+        self.db = db
+        self.batch_size = batch_size
+        self.trim = trim
+        self.now = datetime.datetime.now()
+
+        self.name_ids = db.dict_lookup('name', 'id', 'names')
+        self.category_ids = {normalize_title(name): cat_id
+                             for name, cat_id in db.dict_lookup('name', 'id', 'categories').items()}
+        self.memberships = {(row['category_id'], row['name_id'])
+                            for row in db.query('SELECT * FROM category_membership')}
+        self.next_name_id = (db.lookup('MAX(id)', 'names') or 0) + 1
+        self.next_category_id = (db.lookup('MAX(id)', 'categories') or 0) + 1
+
+        self.updates = []
+        self.new_names = []
+        self.new_categories = []
+        self.new_memberships = []
+        # Template categories can only be resolved once all of the category pages have been seen (see finish)
+        self.template_categories = []
+        self.unresolved_languages = collections.Counter()
+
+    def get_category_id(self, title):
+        """Return the id of the category (adding it if it is a given-name category), or None"""
+        title = normalize_title(title)
+        if not title.startswith(CAT_PREFIX):
+            title = CAT_PREFIX + title
+        if title in self.category_ids:
+            return self.category_ids[title]
+        if not LANG_GIVEN_NAMES.match(title):
+            return None
+        cat_id = self.next_category_id
+        self.next_category_id += 1
+        self.category_ids[title] = cat_id
+        self.new_categories.append((cat_id, title))
+        return cat_id
+
+    def add_page(self, page):
+        title = normalize_title(page['title'])
+        if page['ns'] == CATEGORY_NAMESPACE:
+            self.get_category_id(title)
+            return
+        elif page['ns'] != MAIN_NAMESPACE:
+            return
+
+        text = page.get('text', '')
+        category_ids = set()
+        for cat_name in CATEGORY_LINK.findall(text):
+            cat_id = self.get_category_id(cat_name)
+            if cat_id:
+                category_ids.add(cat_id)
+
+        if title in self.name_ids:
+            name_id = self.name_ids[title]
+            self.updates.append((pack_text(text, self.trim), text_hash(text), page.get('revid'), self.now, name_id))
+        elif category_ids or GIVEN_NAME_TEMPLATE.search(text):
+            name_id = self.next_name_id
+            self.next_name_id += 1
+            self.name_ids[title] = name_id
+            self.new_names.append((name_id, title, pack_text(text, self.trim), text_hash(text), page.get('revid'),
+                                   self.now))
+        else:
+            return
+
+        self.add_memberships(name_id, category_ids)
+        for template in get_template_categories(text):
+            self.template_categories.append((name_id, template))
+
+        if len(self.updates) + len(self.new_names) >= self.batch_size:
+            self.flush()
+
+    def add_memberships(self, name_id, category_ids):
+        for cat_id in category_ids:
+            if (cat_id, name_id) not in self.memberships:
+                self.memberships.add((cat_id, name_id))
+                self.new_memberships.append((cat_id, name_id))
+
+    def get_language_names(self):
+        """Map each language code to the name that the given name categories use for it"""
+        language_names = {}
+        for title in self.category_ids:
+            m = LANG_GIVEN_NAMES.match(title)
+            if not m:
+                continue
+            for language_s in [m.group(1), m.group(4)]:
+                if not language_s:
+                    continue
+                try:
+                    language_names.setdefault(language_cache.find(language_s), language_s)
+                except LookupError:
+                    pass
+        return language_names
+
+    def resolve_template_categories(self):
+        """Add the memberships of the categories that the {{given name}} templates put each page in.
+
+        The dump only has the templates, not the categories they generate, so the category names are built from
+        the template parameters. Languages are named the same way as in the existing categories, so templates
+        in a language with no given name categories anywhere in the dump are counted in unresolved_languages"""
+        language_names = self.get_language_names()
+        for name_id, (lang, gender, origins) in self.template_categories:
+            if lang not in language_names:
+                self.unresolved_languages[lang] += 1
+                continue
+            prefix = f'{CAT_PREFIX}{language_names[lang]} {gender + " " if gender else ""}given names'
+            titles = [prefix]
+            for origin in origins:
+                try:
+                    titles.append(f'{prefix} from {language_names[language_cache.find(origin)]}')
+                except (KeyError, LookupError):
+                    self.unresolved_languages[origin] += 1
+            self.add_memberships(name_id, {self.get_category_id(title) for title in titles} - {None})
+        self.template_categories = []
+
+    def finish(self):
+        self.resolve_template_categories()
+        self.flush()
+
+    def flush(self):
+        self.db.bulk_insert('categories', ['id', 'name'], self.new_categories)
+        self.db.bulk_insert('names', ['id', 'name', 'wiki_text', 'text_hash', 'revid', 'last_crawl'], self.new_names)
+        self.db.execute_many('UPDATE names SET wiki_text=?, text_hash=?, revid=?, last_crawl=? WHERE id=?',
+                             self.updates)
+        self.db.bulk_insert('category_membership', ['category_id', 'name_id'], self.new_memberships)
+        self.db.write()
+        self.updates = []
+        self.new_names = []
+        self.new_categories = []
+        self.new_memberships = []
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dump_path', type=pathlib.Path, help='Path to a pages-articles xml(.bz2) dump')
+    parser.add_argument('-b', '--batch-size', type=int, default=1000)
+    parser.add_argument('-t', '--trim-sections', action='store_true',
+                        help='Only store the language sections of each page that contain given name templates')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    language_cache.load()
+    with instrument('ingest_dump', args), WiktionaryDB() as db:
+        ingester = DumpIngester(db, args.batch_size, args.trim_sections)
+        with timer('stage.ingest'), hot_loop():
+            for page in tqdm(iter_pages(args.dump_path), unit=' pages'):
+                count('pages')
+                ingester.add_page(page)
+        with timer('stage.write'):
+            ingester.finish()
+    language_cache.save()
+    for lang, c in ingester.unresolved_languages.most_common():
+        click.secho(f'{c:4d} template categories in unknown language {lang}', fg='yellow')
@@ -0,0 +1,64 @@
+import collections
+import importlib.metadata
+import langcodes
+import os
+import pathlib
+import yaml
+
+CACHE_PATH = pathlib.Path(__file__).parent / 'langcodes_cache.yaml'
+
+
+class LanguageCache:
+    """Memoizes langcodes.find (including failed lookups), persisted to disk between runs.
+
+    The cache is discarded whenever the installed version of langcodes changes."""
+
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self.version = importlib.metadata.version('langcodes')
+        self.lookups = {}
+        self.new_lookups = {}
+        self.counts = collections.Counter()
+
+    def load(self):
+        if not self.path.exists():
+            return
+        with open(self.path) as f:
+            data = yaml.safe_load(f) or {}
+        if data.get('langcodes_version') == self.version:
+            self.lookups = data.get('lookups', {})
+
+    def save(self):
+        if not self.new_lookups:
+            return
+        data = {'langcodes_version': self.version, 'lookups': self.lookups}
+        # Written to a temporary file and renamed, so a concurrent load never sees a partial file
+        temp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(temp_path, 'w') as f:
+            yaml.safe_dump(data, f, allow_unicode=True)
+        os.replace(temp_path, self.path)
+        self.new_lookups = {}
+
+    def find(self, s):
+        """Return the language code for s as a string, or raise a LookupError if it is not a known language"""
+        if s in self.lookups:
+            self.counts['hits'] += 1
+            code = self.lookups[s]
+        else:
+            self.counts['misses'] += 1
+            try:
+                code = str(langcodes.find(s))
+            except LookupError:
+                code = None
+            self.lookups[s] = code
+            self.new_lookups[s] = code
+
+        if code is None:
+            raise LookupError(f"Can't find language {s!r}")
+        return code
+
+    def merge(self, new_lookups, counts):
+        """Merge in the lookups and counts accumulated by another copy of the cache (i.e. in a worker process)"""
+        self.lookups.update(new_lookups)
+        self.new_lookups.update(new_lookups)
+        self.counts.update(counts)
@@ -0,0 +1,44 @@
+import argparse
+import click
+from tqdm import tqdm
+
+from . import WiktionaryDB, WikiText
+from .parse import trim_sections
+
+
+def compress_pages(db, trim=False, batch_size=1000):
+    """Rewrite the stored page text compressed (and optionally trimmed). Returns the number of pages rewritten.
+
+    Without trim, pages that are already compressed are skipped, so this can be safely rerun."""
+    clause = 'wiki_text IS NOT NULL' if trim else "typeof(wiki_text) == 'text'"
+    ids = [row['id'] for row in db.query(f'SELECT id FROM names WHERE {clause}')]
+    for i in tqdm(range(0, len(ids), batch_size)):
+        batch = ids[i:i + batch_size]
+        placeholders = ', '.join(['?'] * len(batch))
+        rows = db.execute(f'SELECT id, wiki_text FROM names WHERE id IN ({placeholders})', batch).fetchall()
+        updates = []
+        for row in rows:
+            wiki_text = trim_sections(row['wiki_text']) if trim else row['wiki_text']
+            updates.append((WikiText(wiki_text), row['id']))
+        db.execute_many('UPDATE names SET wiki_text=? WHERE id=?', updates)
+        db.write()
+    return len(ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert the stored page text to the compressed format')
+    parser.add_argument('-t', '--trim-sections', action='store_true',
+                        help='Also drop the language sections of each page that do not contain given name templates')
+    parser.add_argument('-b', '--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    db = WiktionaryDB()
+    db.update_database_structure()
+    before = db.path.stat().st_size
+    count = compress_pages(db, args.trim_sections, args.batch_size)
+    db.write()
+    db.execute('VACUUM')
+    after = db.path.stat().st_size
+    db.close(print_table_sizes=False)
+    click.secho(f'Rewrote {count} pages. Database went from {before / 2**20:.1f} MiB to {after / 2**20:.1f} MiB',
+                fg='green')
@@ -2,18 +2,26 @@ import argparse
 import collections
 import click
 import datetime
-import langcodes
+import functools
+import multiprocessing
 import mwparserfromhell
 from tqdm import tqdm
 import re
 
+from instrumentation import add_arguments, count, hot_loop, instrument, timer
 from . import WiktionaryDB, Relationship, GenderFlag
-from .scrape import CAT_PREFIX
+from .langcache import LanguageCache
+from .scrape import CAT_PREFIX, text_hash
 
 
 LANGUAGE_PREFIX = re.compile(CAT_PREFIX + r'\w\w:.*$')
 LANG_GIVEN_NAMES = re.compile(CAT_PREFIX + r'(.*?) (male |female |unisex |)given names( from (.+))?$')
 TRAILING_NUMBER = re.compile(r'([a-z_]+)(\d+)')
+# Increment whenever a change to the parsing logic should cause all pages to be reparsed
+PARSER_VERSION = 1
+NAME_QUERY = ('SELECT names.id, name, wiki_text, parsed_hash, parser_version FROM names'
+              ' LEFT JOIN name_info ON names.id == name_info.id WHERE wiki_text IS NOT NULL')
+STALE_QUERY = 'SELECT DISTINCT name_id FROM unresolved_targets JOIN names ON other_name == names.name'
 TEMPLATE_ARGS = {
     'given name': {
         1: 'lang',
@@ -36,6 +44,8 @@ TEMPLATE_ARGS = {
 
 languages = collections.Counter()
 stats = collections.Counter()
+errors = collections.Counter()
+language_cache = LanguageCache()
 
 
 def merge_dict(a, b):
@@ -66,7 +76,7 @@ def parse_category(cat_name, debug=False):
     if m:
         language_s, gender_s, _, origin_s = m.groups()
         try:
-            info['cat.lang'] = str(langcodes.find(language_s))
+            info['cat.lang'] = language_cache.find(language_s)
         except LookupError:
             languages[language_s] += 1
             if debug:
@@ -79,7 +89,7 @@ def parse_category(cat_name, debug=False):
 
         if origin_s:
             try:
-                info['cat.origin'] = str(langcodes.find(origin_s))
+                info['cat.origin'] = language_cache.find(origin_s)
             except LookupError:
                 languages[origin_s] += 1
                 if debug:
@@ -91,11 +101,16 @@ def parse_category(cat_name, debug=False):
     return info
 
 
-def parse_categories(db, name_id, debug=False):
+def load_category_names(db):
+    category_names = collections.defaultdict(list)
+    for row in db.query('SELECT name_id, name FROM category_membership LEFT JOIN categories ON category_id==id'):
+        category_names[row['name_id']].append(row['name'])
+    return category_names
+
+
+def parse_categories(category_names, debug=False):
     results = collections.defaultdict(set)
-    for cat_name in db.lookup_all('name',
-                                  'category_membership LEFT JOIN categories ON category_id==id',
-                                  {'name_id': name_id}):
+    for cat_name in category_names:
         info = parse_category(cat_name, debug=debug)
         for k, v in info.items():
             results[k].add(v)
@@ -131,7 +146,7 @@ def parse_macro(template, param_names, debug=False):
                 continue
 
             try:
-                value = str(langcodes.find(value))
+                value = language_cache.find(value)
             except LookupError:
                 languages[value] += 1
                 if debug:
@@ -144,11 +159,78 @@ def parse_macro(template, param_names, debug=False):
     return d
 
 
-def parse_wiki(name, wiki_text, debug=False):
+TEMPLATE_START = re.compile(r'\{\{(' + '|'.join(map(re.escape, TEMPLATE_ARGS)) + r')(?=\||\}\})')
+BRACE_TOKEN = re.compile(r'\{\{|\}\}|<!--')
+COMMENT = re.compile(r'<!--.*?-->', re.DOTALL)
+# Pages with these tags (or with runs of three or more braces) are ambiguous to scan, so they always get a full parse
+FULL_PARSE_TAGS = re.compile(r'<(nowiki|pre|math|source|syntaxhighlight)\b', re.IGNORECASE)
+LANGUAGE_HEADING = re.compile(r'^==[^=].*==[ \t]*$', re.MULTILINE)
+
+
+def find_template_end(wiki_text, start):
+    """Return the index just past the }} that closes the template starting at start (or None if it is unclosed)"""
+    depth = 0
+    m = BRACE_TOKEN.search(wiki_text, start)
+    while m:
+        token = m.group(0)
+        if token == '<!--':
+            # Unterminated comments are treated as plain text
+            end = wiki_text.find('-->', m.end())
+            m = BRACE_TOKEN.search(wiki_text, m.end() if end == -1 else end + 3)
+            continue
+        elif token == '{{':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return m.end()
+        m = BRACE_TOKEN.search(wiki_text, m.end())
+
+
+def prescan_templates(wiki_text):
+    """Find the outermost spans of wiki_text that are templates named in TEMPLATE_ARGS.
+
+    Returns None if the page can't be reliably scanned and needs a full parse."""
+    if '{{{' in wiki_text or FULL_PARSE_TAGS.search(wiki_text):
+        return None
+    comments = [m.span() for m in COMMENT.finditer(wiki_text)] if '<!--' in wiki_text else []
+    spans = []
+    last_end = 0
+    for m in TEMPLATE_START.finditer(wiki_text):
+        start = m.start()
+        if start < last_end or any(c_start <= start < c_end for c_start, c_end in comments):
+            continue
+        end = find_template_end(wiki_text, start)
+        if end is None:
+            return None
+        spans.append(wiki_text[start:end])
+        last_end = end
+    return spans
+
+
+def trim_sections(wiki_text):
+    """Drop the language sections of the page that don't contain any of the templates in TEMPLATE_ARGS"""
+    starts = [m.start() for m in LANGUAGE_HEADING.finditer(wiki_text)]
+    if not starts:
+        return wiki_text
+    sections = [wiki_text[start:end] for start, end in zip(starts, starts[1:] + [len(wiki_text)])]
+    return ''.join(section for section in sections if TEMPLATE_START.search(section))
+
+
+def filter_templates(wiki_text, prescan=True):
+    spans = prescan_templates(wiki_text) if prescan else None
+    if spans is None:
+        return mwparserfromhell.parse(wiki_text).filter_templates()
+    templates = []
+    for span in spans:
+        templates += mwparserfromhell.parse(span).filter_templates()
+    return templates
+
+
+def parse_wiki(name, wiki_text, debug=False, prescan=True):
     info = {}
     hit = False
-    wikicode = mwparserfromhell.parse(wiki_text)
-    for template in wikicode.filter_templates():
+    for template in filter_templates(wiki_text, prescan):
         template_name = str(template.name)
         if template_name not in TEMPLATE_ARGS:
             continue
@@ -164,8 +246,8 @@ def parse_wiki(name, wiki_text, debug=False):
     return info
 
 
-def parse_name(db, name_id, name, wiki_text, debug=False):
-    categories = parse_categories(db, name_id, debug=debug)
+def parse_name(category_names, name, wiki_text, debug=False):
+    categories = parse_categories(category_names, debug=debug)
     if categories:
         stats['categories'] += 1
     if debug:
@@ -181,64 +263,234 @@ def parse_name(db, name_id, name, wiki_text, debug=False):
     return info
 
 
+class ParseWriter:
+    """Collects the parse results in memory (skipping rows that already exist) and writes them in bulk.
+
+    The old rows of each page are only deleted when its new results are written, so pages that fail to parse keep
+    their previous results"""
+
+    TABLE_FIELDS = {
+        'name_lang': ['name_id', 'lang'],
+        'name_origin': ['name_id', 'lang'],
+        'relationships': ['name_id', 'relationship', 'name_id2'],
+        'unresolved_targets': ['name_id', 'other_name'],
+    }
+
+    def __init__(self, db):
+        self.db = db
+        self.name_ids = db.dict_lookup('name', 'id', 'names')
+        # The existing rows of each table, by name_id
+        self.existing = {}
+        self.rows = {}
+        for table, fields in self.TABLE_FIELDS.items():
+            self.existing[table] = collections.defaultdict(set)
+            for row in db.select(table, fields):
+                self.existing[table][row[0]].add(tuple(row))
+            self.rows[table] = []
+        self.reparsed_ids = set()
+        self.name_info = {}
+
+    def add(self, table, row):
+        existing = self.existing[table][row[0]]
+        if row in existing:
+            return
+        existing.add(row)
+        self.rows[table].append(row)
+
+    def write_name(self, name_id, name, parsed_info, parsed_hash=None):
+        # Build the page's rows first, so that a page that raises partway through keeps its old results
+        # and is not marked as parsed
+        rows = []
+        gender_flag = 0
+        for key, value in parsed_info.items():
+            src, field = key.split('.')
+            if field in ['lang', 'origin']:
+                for lang in sorted(value):
+                    rows.append((f'name_{field}', (name_id, lang)))
+            elif field in ['eq', 'var', 'dim', 'diminutive', 'varform']:
+                rel = Relationship.lookup(field)
+                for other_name in sorted(value):
+                    if other_name == name:
+                        continue
+                    name_id2 = self.name_ids.get(other_name)
+                    if not name_id2:
+                        # Recorded so that the page is reparsed if the other name is added later
+                        rows.append(('unresolved_targets', (name_id, other_name)))
+                        continue
+                    rows.append(('relationships', (name_id, rel, name_id2)))
+            elif field == 'gender':
+                for gender_s in value:
+                    gender_f = GenderFlag[gender_s.upper()]
+                    gender_flag |= gender_f
+            else:
+                raise RuntimeError(f'Unable to process field: {field}')
+
+        # The new results replace the old ones
+        if name_id not in self.reparsed_ids:
+            self.reparsed_ids.add(name_id)
+            for table in self.TABLE_FIELDS:
+                self.existing[table].pop(name_id, None)
+        for table, row in rows:
+            self.add(table, row)
+        self.name_info[name_id] = (name_id, datetime.datetime.now(), gender_flag, parsed_hash, PARSER_VERSION)
+
+    def flush(self):
+        for table, fields in self.TABLE_FIELDS.items():
+            self.db.execute_many(f'DELETE FROM {table} WHERE name_id=?', [(name_id,) for name_id in self.reparsed_ids])
+            self.db.bulk_insert(table, fields, self.rows[table])
+            self.rows[table] = []
+        self.reparsed_ids = set()
+        self.db.execute_many('INSERT INTO name_info (id, last_parse, gender_flag, parsed_hash, parser_version) '
+                             'VALUES (?, ?, ?, ?, ?) '
+                             'ON CONFLICT(id) DO UPDATE SET last_parse=excluded.last_parse, '
+                             'gender_flag=excluded.gender_flag, parsed_hash=excluded.parsed_hash, '
+                             'parser_version=excluded.parser_version', list(self.name_info.values()))
+        self.name_info = {}
+        self.db.write()
+
+
+def get_parse_hash(wiki_text, category_names):
+    """Hash of all of the inputs to parse_name, used to decide whether a page needs to be reparsed"""
+    return text_hash('\n'.join([wiki_text] + sorted(category_names)))
+
+
+def load_stale_ids(db):
+    """The ids of the pages with relationships to names that were missing when they were parsed, but now exist"""
+    return {row['name_id'] for row in db.query(STALE_QUERY)}
+
+
+def select_pages(rows, category_names, incremental=True, stale_ids=()):
+    """Return the (id, name, wiki_text, category_names) of each page to parse, and the parse hash of each one.
+
+    If incremental, pages that were already parsed from the same inputs with the current parser are skipped,
+    unless they are in stale_ids"""
+    names = []
+    parse_hashes = {}
+    for row in rows:
+        row_categories = category_names.get(row['id'], [])
+        parse_hash = get_parse_hash(row['wiki_text'], row_categories)
+        is_current = (parse_hash == row['parsed_hash'] and row['parser_version'] == PARSER_VERSION
+                      and row['id'] not in stale_ids)
+        if incremental and is_current:
+            continue
+        names.append((row['id'], row['name'], row['wiki_text'], row_categories))
+        parse_hashes[row['id']] = parse_hash
+    return names, parse_hashes
+
+
+def parse_serial(names, debug=False):
+    for name_id, name, wiki_text, category_names in names:
+        try:
+            yield name_id, name, parse_name(category_names, name, wiki_text, debug=debug)
+        except NotImplementedError:
+            raise
+        except Exception as e:
+            errors[str(e), str(type(e))] += 1
+
+
+def parse_chunk(chunk, debug=False):
+    """Parse a chunk of (id, name, wiki_text, category_names) rows in a worker process.
+
+    Returns the parsed results along with the counters accumulated while parsing the chunk"""
+    languages.clear()
+    stats.clear()
+    errors.clear()
+    language_cache.new_lookups = {}
+    language_cache.counts.clear()
+    results = list(parse_serial(chunk, debug=debug))
+    return results, languages, stats, errors, language_cache.new_lookups, language_cache.counts
+
+
+def init_worker():
+    # Workers that are spawned rather than forked start with an empty cache
+    if not language_cache.lookups:
+        language_cache.load()
+
+
+def parse_parallel(names, jobs, chunk_size, debug=False):
+    chunks = [names[i:i + chunk_size] for i in range(0, len(names), chunk_size)]
+    parse_fn = functools.partial(parse_chunk, debug=debug)
+    with multiprocessing.Pool(jobs, initializer=init_worker) as pool:
+        for chunk_results in pool.imap(parse_fn, chunks):
+            results, chunk_languages, chunk_stats, chunk_errors, new_lookups, cache_counts = chunk_results
+            languages.update(chunk_languages)
+            stats.update(chunk_stats)
+            errors.update(chunk_errors)
+            language_cache.merge(new_lookups, cache_counts)
+            yield from results
+
+
+def compare_prescan(names):
+    """Check that parsing with the template prescan gives the same results as parsing the full page"""
+    mismatches = 0
+    for name_id, name, wiki_text, category_names in tqdm(names):
+        fast = parse_wiki(name, wiki_text, prescan=True)
+        full = parse_wiki(name, wiki_text, prescan=False)
+        if fast != full:
+            mismatches += 1
+            click.secho(f'Prescan mismatch for {name}: {fast} != {full}', fg='red')
+    color = 'red' if mismatches else 'green'
+    click.secho(f'{mismatches}/{len(names)} pages differ when using the template prescan', fg=color)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('name', nargs='?')
     parser.add_argument('-d', '--debug', action='store_true')
+    parser.add_argument('-a', '--all', action='store_true',
+                        help='Reparse all pages, not just the ones whose text or categories have changed')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes to parse with')
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--compare-prescan', action='store_true',
+                        help='Instead of writing results, check the template prescan against full page parses')
+    add_arguments(parser)
     args = parser.parse_args()
 
-    errors = collections.Counter()
-
-    name_query = 'SELECT id, name, wiki_text FROM names WHERE wiki_text IS NOT NULL'
-    if args.name:
-        name_query += f' AND name == "{args.name}"'
-    else:
-        name_query += ' ORDER BY name'
-
-    try:
-        with WiktionaryDB() as db:
-            names = list(db.query(name_query))
-            for name_d in tqdm(names):
-                try:
-                    parsed_info = parse_name(db, name_d['id'], name_d['name'], name_d['wiki_text'],
-                                             debug=args.name is not None or args.debug)
-                    gender_flag = 0
-                    for key, value in parsed_info.items():
-                        src, field = key.split('.')
-                        if field in ['lang', 'origin']:
-                            for lang in value:
-                                db.unique_insert(f'name_{field}', {'name_id': name_d['id'], 'lang': lang})
-                        elif field in ['eq', 'var', 'dim', 'diminutive', 'varform']:
-                            rel = Relationship.lookup(field)
-                            entry = {
-                                'name_id': name_d['id'],
-                                'relationship': rel,
-                            }
-                            for other_name in value:
-                                if other_name == name_d['name']:
-                                    continue
-                                entry['name_id2'] = db.lookup('id', 'names', {'name': other_name})
-                                if not entry['name_id2']:
-                                    continue
-                                db.unique_insert('relationships', entry)
-                        elif field == 'gender':
-                            for gender_s in value:
-                                gender_f = GenderFlag[gender_s.upper()]
-                                gender_flag |= gender_f
-                        else:
-                            raise RuntimeError(f'Unable to process field: {field}')
-
-                        name_info = {'id': name_d['id'], 'last_parse': datetime.datetime.now(),
-                                     'gender_flag': gender_flag}
-                        db.update('name_info', name_info)
-                except Exception as e:
-                    if isinstance(e, NotImplementedError):
-                        raise e
-                    errors[str(e), str(type(e))] += 1
-    finally:
-        for k, v in languages.most_common():
-            click.secho(f'{v:4d} {k}', bg='blue')
-        for k, v in errors.most_common():
-            click.secho(f'{v:4d} {k}', bg='yellow', fg='black')
-        for key, c in stats.items():
-            click.secho(f'Parsed {key} for {c}/{len(names)} names ({c*100/len(names):.2f}%)', fg='blue')
+    with instrument('parse_wiki', args):
+        name_query = NAME_QUERY
+        if args.name:
+            name_query += f' AND name == "{args.name}"'
+        else:
+            name_query += ' ORDER BY name'
+
+        names = []
+        debug = args.name is not None or args.debug
+        incremental = not (args.name or args.all or args.compare_prescan)
+        language_cache.load()
+        try:
+            with WiktionaryDB() as db:
+                with timer('stage.load'):
+                    category_names = load_category_names(db)
+                    names, parse_hashes = select_pages(db.query(name_query), category_names, incremental,
+                                                       load_stale_ids(db))
+
+                if args.compare_prescan:
+                    compare_prescan(names)
+                    return
+                elif args.jobs > 1:
+                    results = parse_parallel(names, args.jobs, args.chunk_size, debug=debug)
+                else:
+                    results = parse_serial(names, debug=debug)
+
+                writer = ParseWriter(db)
+                with timer('stage.parse'), hot_loop():
+                    for name_id, name, parsed_info in tqdm(results, total=len(names)):
+                        try:
+                            writer.write_name(name_id, name, parsed_info, parse_hashes[name_id])
+                        except Exception as e:
+                            if isinstance(e, NotImplementedError):
+                                raise e
+                            errors[str(e), str(type(e))] += 1
+                count('pages', len(names))
+                with timer('stage.write'):
+                    writer.flush()
+        finally:
+            for k, v in languages.most_common():
+                click.secho(f'{v:4d} {k}', bg='blue')
+            click.secho(f'langcodes cache: {language_cache.counts["hits"]} hits, '
+                        f'{language_cache.counts["misses"]} misses', bg='blue')
+            language_cache.save()
+            for k, v in errors.most_common():
+                click.secho(f'{v:4d} {k}', bg='yellow', fg='black')
+            for key, c in stats.items():
+                click.secho(f'Parsed {key} for {c}/{len(names)} names ({c*100/len(names):.2f}%)', fg='blue')
@@ -0,0 +1,216 @@
+"""Refresh the pages, parse them and dump them to the bucket files in a single streaming pass.
+
+The pages are processed one bucket at a time, with each stage running concurrently:
+
+ * A fetch thread downloads the pages of each bucket with the WikiAPI
+ * The main thread stores the pages as they arrive, and parses each bucket once all of its pages are stored
+ * A dump thread writes each parsed bucket to its bucket file
+
+The stages are connected by bounded queues, so a fast stage can only get a few batches ahead of a slow one.
+Fetching and parsing are recorded in the database as they happen, and the dumped buckets in the checkpoint file,
+so an interrupted run picks up where it left off."""
+import argparse
+import click
+import json
+import pathlib
+import queue
+import threading
+from tqdm import tqdm
+
+from buckets import update_bucket
+from instrumentation import add_arguments, count, hot_loop, instrument, timer
+from . import WiktionaryDB
+from .api import WikiAPI, API_ENDPOINT, MAX_TITLES
+from .dump import ROOT, get_update, group_by_bucket, merge_streams, to_yaml_dict, update_entry
+from .parse import (NAME_QUERY, ParseWriter, errors, language_cache, load_category_names, load_stale_ids,
+                    parse_serial, select_pages)
+from .scrape import find_changed_pages, get_revision_updates, store_revision_updates
+
+CHECKPOINT_PATH = pathlib.Path(__file__).parent / 'pipeline_checkpoint.json'
+BUCKET_QUERY = NAME_QUERY + ' AND names.id IN (SELECT value FROM json_each(?))'
+
+
+class Checkpoint:
+    """The buckets that have been completely dumped during the current run, saved after each one"""
+
+    def __init__(self, path=CHECKPOINT_PATH, restart=False):
+        self.path = path
+        self.done = set()
+        if self.path.exists() and not restart:
+            self.done = {tuple(bucket) for bucket in json.load(open(self.path))['done']}
+
+    def add(self, bucket):
+        self.done.add(bucket)
+        with open(self.path, 'w') as f:
+            json.dump({'done': sorted(self.done)}, f)
+
+    def finish(self):
+        self.path.unlink(missing_ok=True)
+
+
+class Stage(threading.Thread):
+    """Calls fn(*args) in a daemon thread, keeping any exception so that the main thread can raise it"""
+
+    def __init__(self, name, fn, *args):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self.fn = fn
+        self.args = args
+        self.error = None
+
+    def run(self):
+        try:
+            self.fn(*self.args)
+        except Exception as e:
+            self.error = e
+
+    def check(self):
+        if self.error:
+            raise RuntimeError(f'{self.name} stage failed') from self.error
+
+    def put(self, in_queue, item):
+        """Put the item in this stage's input queue, unless the stage stops while waiting for space"""
+        while self.is_alive():
+            try:
+                in_queue.put(item, timeout=1.0)
+                return
+            except queue.Full:
+                pass
+        self.check()
+
+    def stop(self, in_queue):
+        """Let the stage finish the items already in its queue, then wait for it to end"""
+        self.put(in_queue, None)
+        self.join()
+        self.check()
+
+
+def fetch_pages(api, buckets, to_fetch, batch_size, trim, out_queue):
+    """Put (bucket, revision updates) for each batch of fetched pages in the queue, then (bucket, None) once
+    all of the pages in the bucket have been fetched. The queue ends with None"""
+    for bucket, names in buckets:
+        names = {name_d['name']: name_d for name_d in names if name_d['name'] in to_fetch}
+        for revisions in api.map_batches(api.page_revisions, sorted(names), batch_size):
+            out_queue.put((bucket, get_revision_updates(names, revisions, trim)))
+        out_queue.put((bucket, None))
+    out_queue.put(None)
+
+
+def dump_buckets(in_queue, checkpoint):
+    """Write each (bucket, updates) from the queue to its bucket file, until the queue yields None"""
+    while True:
+        item = in_queue.get()
+        if item is None:
+            return
+        bucket, updates = item
+        with timer('stage.dump'):
+            update_bucket(bucket, ROOT, updates, update_entry, to_yaml_dict)
+        checkpoint.add(bucket)
+
+
+def parse_bucket(db, writer, category_names, name_ids):
+    """Parse the pages in the bucket that have changed since they were last parsed, and write the results"""
+    rows = db.execute(BUCKET_QUERY, (json.dumps(sorted(name_ids)),))
+    names, parse_hashes = select_pages(rows, category_names, stale_ids=load_stale_ids(db))
+    for name_id, name, parsed_info in parse_serial(names):
+        try:
+            writer.write_name(name_id, name, parsed_info, parse_hashes[name_id])
+        except Exception as e:
+            if isinstance(e, NotImplementedError):
+                raise e
+            errors[str(e), str(type(e))] += 1
+    writer.flush()
+    return len(names)
+
+
+def run_pipeline(db, api, args):
+    checkpoint = Checkpoint(restart=args.restart)
+    if checkpoint.done:
+        click.secho(f'Resuming from {checkpoint.path} ({len(checkpoint.done)} buckets already done)', fg='yellow')
+
+    fields = 'id, name, revid, text_hash, wiki_text IS NULL AS missing'
+    names = [dict(row) for row in db.query(f'SELECT {fields} FROM names')]
+    to_fetch = {name_d['name'] for name_d in names if name_d['missing']}
+    if args.recrawl_pages:
+        crawled = [name_d for name_d in names if not name_d['missing']]
+        to_fetch.update(row['name'] for row in find_changed_pages(api, crawled, 'revid', 'lastrevid'))
+    buckets = [(bucket, bucket_names) for bucket, bucket_names in group_by_bucket(names)
+               if bucket not in checkpoint.done]
+    bucket_ids = {bucket: [name_d['id'] for name_d in bucket_names] for bucket, bucket_names in buckets}
+    count('pages', sum(len(name_ids) for name_ids in bucket_ids.values()))
+
+    fetched = queue.Queue(args.queue_size)
+    parsed = queue.Queue(args.queue_size)
+    fetcher = Stage('fetch', fetch_pages, api, buckets, to_fetch, args.batch_size, args.trim_sections, fetched)
+    dumper = Stage('dump', dump_buckets, parsed, checkpoint)
+    fetcher.start()
+    dumper.start()
+
+    category_names = load_category_names(db)
+    writer = ParseWriter(db)
+    bar = tqdm(total=len(buckets), unit=' buckets')
+    try:
+        while True:
+            # Time out regularly, so that the main thread notices if the fetch thread has failed
+            try:
+                item = fetched.get(timeout=1.0)
+            except queue.Empty:
+                fetcher.check()
+                continue
+            if item is None:
+                break
+
+            bucket, updates = item
+            if updates is not None:
+                count('pages.fetched', len(updates[0]) + len(updates[1]))
+                with timer('stage.store'):
+                    store_revision_updates(db, *updates)
+                continue
+
+            bar.set_description(f'{" ".join(bucket):20}')
+            with timer('stage.parse'), hot_loop():
+                count('pages.parsed', parse_bucket(db, writer, category_names, bucket_ids[bucket]))
+            with timer('stage.merge'):
+                updates = [(name_d['name'], get_update(name_d, field_rows))
+                           for name_d, field_rows in merge_streams(db, bucket_ids[bucket])]
+            dumper.put(parsed, (bucket, updates))
+            bar.update()
+    except BaseException:
+        bar.close()
+        # Let the dump thread finish the buckets it has already been given, so they are checkpointed,
+        # without letting a failure while stopping it replace the original error
+        try:
+            dumper.stop(parsed)
+        except Exception as e:
+            click.secho(f'The dump stage failed as well: {e.__cause__ or e!r}', fg='red')
+        raise
+    bar.close()
+    dumper.stop(parsed)
+    checkpoint.finish()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fetch, parse and dump the name pages in one pass')
+    parser.add_argument('-p', '--recrawl-pages', action='store_true',
+                        help='Recrawl pages whose revision has changed since they were last crawled')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of concurrent requests')
+    parser.add_argument('-b', '--batch-size', type=int, default=MAX_TITLES)
+    parser.add_argument('-r', '--rate', type=float, default=10.0, help='Maximum requests per second')
+    parser.add_argument('-q', '--queue-size', type=int, default=4,
+                        help='Number of batches (or buckets) each stage can get ahead of the next one')
+    parser.add_argument('--restart', action='store_true',
+                        help='Ignore the checkpoint of an interrupted run and start over')
+    parser.add_argument('--endpoint', default=API_ENDPOINT)
+    parser.add_argument('-t', '--trim-sections', action='store_true',
+                        help='Only store the language sections of each page that contain given name templates')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    language_cache.load()
+    try:
+        with instrument('refresh_wiki', args), WiktionaryDB() as db:
+            api = WikiAPI(args.endpoint, jobs=args.jobs, rate=args.rate)
+            run_pipeline(db, api, args)
+    finally:
+        language_cache.save()
+        for k, v in errors.most_common():
+            click.secho(f'{v:4d} {k}', bg='yellow', fg='black')
@@ -1,9 +1,12 @@
 import argparse
 import click
 import datetime
+import hashlib
 from tqdm import tqdm
 
-from . import WiktionaryDB
+from instrumentation import add_arguments, count, hot_loop, instrument, timer
+from . import WiktionaryDB, WikiText
+from .api import WikiAPI, API_ENDPOINT, MAX_TITLES
 
 # NB: pwiki imports are done inside methods to ensure only scraping is done in python3.9
 
@@ -12,11 +15,37 @@ CAT_PREFIX = 'Category:'
 ROOT_CATEGORY = CAT_PREFIX + 'Given_names_by_language'
 
 
+def text_hash(text):
+    if text is None:
+        return None
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def find_changed_pages(api, rows, field, api_field):
+    """Return the rows whose stored value of field does not match the current api_field value from the wiki.
+
+    The returned rows are updated with the current value."""
+    rows = {row['name']: dict(row) for row in rows}
+    changed = []
+    bar = tqdm(total=len(rows), desc='Checking for changes')
+    for info in api.map_batches(api.page_info, sorted(rows)):
+        for title, page in info.items():
+            row = rows[title]
+            value = page.get(api_field)
+            if value != row[field]:
+                row[field] = value
+                changed.append(row)
+        bar.update(len(info))
+    bar.close()
+    return sorted(changed, key=lambda d: d['name'])
+
+
 def crawl_category(db, wiki, category_d):
     from pwiki.gquery import GQuery
     cat_id = category_d['id']
     cat_name = category_d['name']
     bar = tqdm(total=wiki.category_size(cat_name))
+    members = set()
     for member_array in GQuery.category_members(wiki, cat_name):
         page_name = member_array[0]
         bar.set_description(f'{page_name:40}')
@@ -25,52 +54,141 @@ def crawl_category(db, wiki, category_d):
         elif ':' in page_name:
             click.secho(f'Ignoring special page {page_name}', fg='yellow')
         else:
-            name_id = db.unique_insert('names', {'name': page_name})
-            db.unique_insert('category_membership', {'category_id': cat_id, 'name_id': name_id})
+            members.add(page_name)
 
         bar.update()
-    db.update('categories', {'id': cat_id, 'last_crawl': datetime.datetime.now()})
-
 
-def crawl_name_page(db, wiki, name_d):
-    name_d['wiki_text'] = wiki.page_text(name_d['name'])
+    member_hash = text_hash('\n'.join(sorted(members)))
+    if member_hash != category_d.get('member_hash'):
+        old_members = db.dict_lookup('name', 'name_id', 'category_membership LEFT JOIN names ON name_id==id',
+                                     {'category_id': cat_id})
+        for page_name in sorted(members - set(old_members)):
+            name_id = db.unique_insert('names', {'name': page_name})
+            db.insert('category_membership', {'category_id': cat_id, 'name_id': name_id})
+        for page_name in sorted(set(old_members) - members):
+            db.delete('category_membership', {'category_id': cat_id, 'name_id': old_members[page_name]})
+
+    db.update('categories', {'id': cat_id, 'last_crawl': datetime.datetime.now(),
+                             'touched': category_d.get('touched'), 'member_hash': member_hash})
+
+
+def pack_text(wiki_text, trim=False):
+    """Prepare the page text for storage (compressed, and optionally with only the relevant sections)"""
+    if wiki_text is None:
+        return None
+    if trim:
+        # Imported here since parse imports this module
+        from .parse import trim_sections
+        wiki_text = trim_sections(wiki_text)
+    return WikiText(wiki_text)
+
+
+def fill_touched(api, categories):
+    """Set the touched timestamp of categories that have never been checked, before they are crawled.
+
+    Otherwise they would be stored without one, and the first --recrawl-categories would recrawl all of them"""
+    categories = {category_d['name']: category_d for category_d in categories if not category_d.get('touched')}
+    for info in api.map_batches(api.page_info, sorted(categories)):
+        for title, page in info.items():
+            categories[title]['touched'] = page.get('touched')
+
+
+def crawl_name_page(db, api, name_d, trim=False):
+    # The revid is stored along with the text (as in crawl_name_pages) so that --recrawl-pages can skip the page
+    revid, wiki_text = api.page_revisions([name_d['name']])[name_d['name']]
+    # The hash is always of the full page, so that trimming doesn't affect detecting changes
+    new_hash = text_hash(wiki_text)
+    if new_hash != name_d.get('text_hash'):
+        name_d['wiki_text'] = pack_text(wiki_text, trim)
+        name_d['text_hash'] = new_hash
+    name_d['revid'] = revid
     name_d['last_crawl'] = datetime.datetime.now()
     db.update('names', name_d)
 
 
-def main():
-    from pwiki.wiki import Wiki
+def get_revision_updates(names, revisions, trim=False):
+    """Split a batch of page_revisions results into the rows for store_revision_updates.
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-c', '--recrawl-categories', action='store_true')
-    parser.add_argument('-p', '--recrawl-pages', action='store_true')
-    args = parser.parse_args()
+    names maps each title to its row from the names table"""
+    now = datetime.datetime.now()
+    changed = []
+    unchanged = []
+    for title, (revid, wiki_text) in revisions.items():
+        name_d = names[title]
+        new_hash = text_hash(wiki_text)
+        if new_hash == name_d.get('text_hash'):
+            unchanged.append((revid, now, name_d['id']))
+        else:
+            changed.append((pack_text(wiki_text, trim), new_hash, revid, now, name_d['id']))
+    return changed, unchanged
 
-    wiki = Wiki('en.wiktionary.org')
 
-    sixty_days_ago = datetime.datetime.now() - datetime.timedelta(days=60)
+def store_revision_updates(db, changed, unchanged):
+    db.execute_many('UPDATE names SET wiki_text=?, text_hash=?, revid=?, last_crawl=? WHERE id=?', changed)
+    db.execute_many('UPDATE names SET revid=?, last_crawl=? WHERE id=?', unchanged)
+    db.write()
 
-    with WiktionaryDB() as db:
-        if db.count('categories') == 0:
-            db.insert('categories', {'name': ROOT_CATEGORY})
 
-        cat_query = 'SELECT * FROM categories WHERE last_crawl IS NULL'
-        if args.recrawl_categories:
-            cat_query += f' OR last_crawl < "{sixty_days_ago}"'
+def crawl_name_pages(db, api, names, batch_size, trim=False):
+    names = {name_d['name']: name_d for name_d in names}
+    bar = tqdm(total=len(names))
+    for revisions in api.map_batches(api.page_revisions, sorted(names), batch_size):
+        store_revision_updates(db, *get_revision_updates(names, revisions, trim))
+        bar.update(len(revisions))
 
-        queue = list(db.query(cat_query))
 
-        bar = tqdm(queue)
-        for category_d in bar:
-            bar.set_description(category_d['name'])
-            crawl_category(db, wiki, category_d)
+def main():
+    from pwiki.wiki import Wiki
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--recrawl-categories', action='store_true',
+                        help='Recrawl categories that have been touched since they were last crawled')
+    parser.add_argument('-p', '--recrawl-pages', action='store_true',
+                        help='Recrawl pages whose revision has changed since they were last crawled')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help='Fetch pages in batches with this many concurrent requests')
+    parser.add_argument('-b', '--batch-size', type=int, default=MAX_TITLES)
+    parser.add_argument('-r', '--rate', type=float, default=10.0, help='Maximum requests per second')
+    parser.add_argument('--endpoint', default=API_ENDPOINT)
+    parser.add_argument('-t', '--trim-sections', action='store_true',
+                        help='Only store the language sections of each page that contain given name templates')
+    add_arguments(parser)
+    args = parser.parse_args()
 
-        name_query = 'SELECT id, name FROM names WHERE wiki_text IS NULL'
-        if args.recrawl_pages:
-            name_query += f' OR (last_crawl IS NULL OR last_crawl < "{sixty_days_ago}")'
-        name_query += ' ORDER BY name'
-        names = list(db.query(name_query))
-        bar = tqdm(names)
-        for name_d in bar:
-            bar.set_description(f"{name_d['name']:20}")
-            crawl_name_page(db, wiki, dict(name_d))
+    with instrument('scrape_wiki', args):
+        wiki = Wiki('en.wiktionary.org')
+        api = WikiAPI(args.endpoint, jobs=max(args.jobs, 1), rate=args.rate)
+
+        with WiktionaryDB() as db:
+            if db.count('categories') == 0:
+                db.insert('categories', {'name': ROOT_CATEGORY})
+
+            queue = [dict(row) for row in db.query('SELECT * FROM categories WHERE last_crawl IS NULL')]
+            if args.recrawl_categories:
+                crawled = db.query('SELECT * FROM categories WHERE last_crawl IS NOT NULL')
+                queue += find_changed_pages(api, crawled, 'touched', 'touched')
+
+            fill_touched(api, queue)
+            with timer('stage.categories'), hot_loop():
+                bar = tqdm(queue)
+                for category_d in bar:
+                    bar.set_description(category_d['name'])
+                    crawl_category(db, wiki, category_d)
+
+            fields = 'id, name, revid, text_hash'
+            names = [dict(row) for row in db.query(f'SELECT {fields} FROM names WHERE wiki_text IS NULL')]
+            if args.recrawl_pages:
+                crawled = db.query(f'SELECT {fields} FROM names WHERE wiki_text IS NOT NULL')
+                names += find_changed_pages(api, crawled, 'revid', 'lastrevid')
+            names.sort(key=lambda d: d['name'])
+
+            count('pages', len(names))
+            with timer('stage.pages'), hot_loop():
+                if args.jobs:
+                    crawl_name_pages(db, api, names, args.batch_size, args.trim_sections)
+                    return
+
+                bar = tqdm(names)
+                for name_d in bar:
+                    bar.set_description(f"{name_d['name']:20}")
+                    crawl_name_page(db, api, name_d, args.trim_sections)